@@ -7,9 +7,20 @@ import datetime as dt
 import os
 import re
 import time
+import threading
+from collections import Counter
+from types import MappingProxyType
 from streamlit_cookies_manager import EncryptedCookieManager
 import secrets
+import random
 import string
+from functools import lru_cache
+from contextlib import contextmanager
+import hashlib
+try:
+    import fcntl  # solo Unix: lock de fichero entre workers
+except ImportError:
+    fcntl = None
 
 # ====== AJUSTES GENERALES ======
 st.set_page_config(page_title="Tecnificaciones CBC ", layout="centered")
@@ -96,18 +107,6 @@ def _norm_name(s: str) -> str:
 FAMILIAS_HEADERS = ["codigo","tutor","telefono","email","updated_at"]
 HIJOS_HEADERS    = ["codigo","jugador","equipo","canasta","updated_at"]
 
-def _ensure_ws(sh, title: str, headers: list[str], cols: int):
-    try:
-        ws = sh.worksheet(title)
-        h = ws.row_values(1)
-        if len(h) < len(headers):
-            _retry_gspread(ws.update, f"A1:{chr(64+len(headers))}1", [headers])
-        return ws
-    except WorksheetNotFound:
-        ws = sh.add_worksheet(title=title, rows=500, cols=cols)
-        _retry_gspread(ws.update, f"A1:{chr(64+len(headers))}1", [headers])
-        return ws
-
 def _gen_family_code(prefix="CBC-", n=10) -> str:
     # 10 chars base32 friendly (sin 0/O, 1/I)
     alphabet = "23456789ABCDEFGHJKLMNPQRSTUVWXYZ"
@@ -151,15 +150,25 @@ def texto_estado_grupo(fecha_iso: str, hora: str, canasta: str) -> tuple[str, st
     return "info", "🟢 **Plazas disponibles**"
 
 
-def _norm_hora(h: str) -> str:
+# Patrones precompilados de los normalizadores
+_HORA_DIGITOS_RE = re.compile(r"\d{3,4}")
+_HORA_H_M_RE = re.compile(r'^(\d{1,2})(?::?(\d{1,2}))?$')
+_HORA_HMS_RE = re.compile(r'^(\d{1,2}):(\d{2}):\d{2}$')
+_ISO_FECHA_PAT = r"\d{4}-\d{2}-\d{2}"
+_DMY_FECHA_PAT = r"\d{1,2}/\d{1,2}/\d{4}"
+_HHMM_CANON_PAT = r"\d{2}:\d{2}"
+_ISO_FECHA_RE = re.compile(_ISO_FECHA_PAT)
+_DMY_FECHA_RE = re.compile(_DMY_FECHA_PAT)
+
+def _norm_hora_impl(h: str) -> str:
     h = (h or "").strip()
     if not h:
         return "—"
-    if re.fullmatch(r"\d{3,4}", h):
+    if _HORA_DIGITOS_RE.fullmatch(h):
         if len(h) == 3:
             h = "0" + h
         return f"{int(h[:2]):02d}:{int(h[2:]):02d}"
-    m = re.match(r'^(\d{1,2})(?::?(\d{1,2}))?$', h)
+    m = _HORA_H_M_RE.match(h)
     if m:
         hh = int(m.group(1))
         mm = int(m.group(2) or 0)
@@ -167,7 +176,7 @@ def _norm_hora(h: str) -> str:
         mm = max(0, min(59, mm))
         return f"{hh:02d}:{mm:02d}"
     # '09:30:00'
-    m2 = re.match(r'^(\d{1,2}):(\d{2}):\d{2}$', h)
+    m2 = _HORA_HMS_RE.match(h)
     if m2:
         return f"{int(m2.group(1)):02d}:{int(m2.group(2)):02d}"
     try:
@@ -178,14 +187,14 @@ def _norm_hora(h: str) -> str:
 # Acepta '09:30', '9:30', '09h30', '930', '09:30-10:30', '09:30 – 10:30', '09:30:00',
 # y objetos time/datetime → '09:30'
 _HHMM_RE = re.compile(r'(?:(\d{1,2})[:hH](\d{2}))|(\b\d{3,4}\b)', re.UNICODE)
-def _parse_hora_cell(x) -> str:
+def _parse_hora_cell_impl(x) -> str:
     if isinstance(x, dt.time):
         return f"{x.hour:02d}:{x.minute:02d}"
     if isinstance(x, dt.datetime):
         return f"{x.hour:02d}:{x.minute:02d}"
     s = str(x or "").strip()
     # primero, si hay patrón HH:MM:SS
-    mss = re.match(r'^(\d{1,2}):(\d{2}):\d{2}$', s)
+    mss = _HORA_HMS_RE.match(s)
     if mss:
         return f"{int(mss.group(1)):02d}:{int(mss.group(2)):02d}"
     # luego, buscar primera hora válida en el texto
@@ -203,15 +212,15 @@ def _parse_hora_cell(x) -> str:
     return _norm_hora(s)
 
 # Normaliza fecha: ISO, dd/mm/yyyy, fecha real de Sheets o serial Excel/Sheets
-def _norm_fecha_iso(x) -> str:
+def _norm_fecha_iso_impl(x) -> str:
     if x is None or x == "":
         return ""
     if isinstance(x, (dt.date, dt.datetime)):
         return (x.date() if isinstance(x, dt.datetime) else x).isoformat()
     s = str(x).strip()
-    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", s):
+    if _ISO_FECHA_RE.fullmatch(s):
         return s
-    if re.fullmatch(r"\d{1,2}/\d{1,2}/\d{4}", s):
+    if _DMY_FECHA_RE.fullmatch(s):
         try:
             d = dt.datetime.strptime(s, "%d/%m/%Y").date()
             return d.isoformat()
@@ -232,6 +241,81 @@ def _norm_fecha_iso(x) -> str:
     except Exception:
         return s
 
+# ---- Memoización acotada de los normalizadores ----
+# Se llaman una y otra vez con las mismas pocas decenas de valores (calendario, selectboxes,
+# búsquedas de filas). Las LRU viven en un cache_resource para que duren más que un rerun.
+NORM_CACHE_SIZE = 4096
+
+@st.cache_resource(show_spinner=False)
+def _norm_caches() -> dict:
+    return {
+        "fecha": lru_cache(maxsize=NORM_CACHE_SIZE, typed=True)(_norm_fecha_iso_impl),
+        "hora": lru_cache(maxsize=NORM_CACHE_SIZE, typed=True)(_parse_hora_cell_impl),
+        "norm_hora": lru_cache(maxsize=NORM_CACHE_SIZE, typed=True)(_norm_hora_impl),
+    }
+
+_NORM = _norm_caches()
+
+def _norm_hora(h: str) -> str:
+    try:
+        return _NORM["norm_hora"](h)
+    except TypeError:  # valor no hashable
+        return _norm_hora_impl(h)
+
+def _parse_hora_cell(x) -> str:
+    try:
+        return _NORM["hora"](x)
+    except TypeError:
+        return _parse_hora_cell_impl(x)
+
+def _norm_fecha_iso(x) -> str:
+    try:
+        return _NORM["fecha"](x)
+    except TypeError:
+        return _norm_fecha_iso_impl(x)
+
+def norm_cache_stats() -> dict:
+    """Aciertos/fallos de las cachés de normalización (para vigilarlas en producción)."""
+    return {nombre: f.cache_info() for nombre, f in _NORM.items()}
+
+# ---- Versiones vectorizadas (columnas de texto tal cual vienen de Sheets) ----
+# Mismo resultado que _norm_fecha_iso / _parse_hora_cell celda a celda, pero resolviendo
+# con operaciones de pandas los formatos habituales. Solo las celdas raras van al camino lento.
+
+def _norm_fecha_iso_col(col: pd.Series) -> pd.Series:
+    s = col.astype(str).str.strip()
+    iso = s.str.fullmatch(_ISO_FECHA_PAT)
+    if iso.all():
+        return s  # ya canónica: nada que hacer
+    out = s.copy()
+    pendiente = ~iso & (s != "")
+    dmy = pendiente & s.str.fullmatch(_DMY_FECHA_PAT)
+    if dmy.any():
+        d = pd.to_datetime(s[dmy], format="%d/%m/%Y", errors="coerce")
+        d = d[d.notna()]
+        out.loc[d.index] = d.dt.strftime("%Y-%m-%d")
+        pendiente.loc[d.index] = False
+    if pendiente.any():
+        out.loc[pendiente] = s[pendiente].map(_norm_fecha_iso)
+    return out
+
+def _parse_hora_col(col: pd.Series) -> pd.Series:
+    s = col.astype(str).str.strip()
+    if s.str.fullmatch(_HHMM_CANON_PAT).all():
+        return s  # ya canónica: nada que hacer
+    out = s.copy()
+    m = s.str.extract(_HHMM_RE)  # primera hora del texto, como _HHMM_RE.search
+    hm = m[0].notna() & m[1].notna()
+    out.loc[hm] = m.loc[hm, 0].str.zfill(2) + ":" + m.loc[hm, 1]
+    raw = m[2].notna() & ~hm
+    if raw.any():
+        r = m.loc[raw, 2].str.zfill(4)
+        out.loc[raw] = r.str[:2] + ":" + r.str[2:]
+    resto = ~hm & ~raw
+    if resto.any():
+        out.loc[resto] = s[resto].map(_norm_hora)
+    return out
+
 def hora_mas(h: str, minutos: int) -> str:
     base = _norm_hora(h)
     try:
@@ -245,6 +329,7 @@ def hora_mas(h: str, minutos: int) -> str:
 import gspread
 from gspread.exceptions import WorksheetNotFound, APIError
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
 
 # Usa ambos scopes (Sheets + Drive) en todas las rutas
 SCOPES = [
@@ -252,13 +337,24 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive.readonly",
 ]
 
+# ====== CONEXIÓN COMPARTIDA (una por proceso) ======
+# Ojo: este script se re-ejecuta en cada rerun, así que cualquier estado o lock
+# que deba ser global al proceso tiene que vivir dentro de un st.cache_resource.
+@st.cache_resource(show_spinner=False)
 def _gc():
+    """Cliente autorizado UNA vez por proceso. AuthorizedSession refresca el token sola."""
     info = dict(st.secrets["gcp_service_account"])
     creds = Credentials.from_service_account_info(info, scopes=SCOPES)
-    return gspread.authorize(creds)
+    gc = gspread.authorize(creds)
+    # Sesión HTTP reutilizada (keep-alive) con pool suficiente para varias sesiones a la vez
+    gc.http_client.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    return gc
+
+@st.cache_resource(show_spinner=False)
+def _open_sheet_by_id(sheet_id: str):
+    return _gc().open_by_key(sheet_id)
 
 def _open_sheet():
-    gc = _gc()
     # Forzamos ID (mejor que URL)
     sheet_id = (
         st.secrets.get("SHEETS_SPREADSHEET_ID")
@@ -269,7 +365,7 @@ def _open_sheet():
         st.error("Falta SHEETS_SPREADSHEET_ID en secrets.")
         st.stop()
     try:
-        return gc.open_by_key(sheet_id)
+        return _open_sheet_by_id(sheet_id)
     except gspread.exceptions.APIError as e:
         st.error("No puedo abrir la hoja por ID (Google Sheets).")
         st.code(f"""ID: {sheet_id}
@@ -278,142 +374,721 @@ Excepción: {type(e).__name__}""")
         st.info("Si la hoja está en **Unidad compartida**, añade la service account como **miembro de la Unidad** (no solo del archivo).")
         st.stop()
 
+@st.cache_resource(show_spinner=False)
+def _ws_handles() -> dict:
+    """Worksheets ya resueltos (título -> Worksheet), compartidos por todas las sesiones."""
+    return {"lock": threading.Lock(), "ws": None}
+
+def _ws_map() -> dict:
+    h = _ws_handles()
+    if h["ws"] is None:
+        with h["lock"]:
+            if h["ws"] is None:
+                # Una sola lectura de metadatos resuelve todas las pestañas
+                h["ws"] = {w.title: w for w in _retry_gspread(_open_sheet().worksheets)}
+    return h["ws"]
+
+def _get_ws(title: str):
+    ws = _ws_map().get(title)
+    if ws is None:
+        # Puede haberse creado a mano desde Sheets: refrescamos la lista una vez
+        h = _ws_handles()
+        with h["lock"]:
+            h["ws"] = {w.title: w for w in _retry_gspread(_open_sheet().worksheets)}
+        ws = h["ws"].get(title)
+    if ws is None:
+        raise WorksheetNotFound(title)
+    return ws
+
+def _add_ws(title: str, rows: int, cols: int):
+    ws = _retry_gspread(_open_sheet().add_worksheet, title=title, rows=rows, cols=cols)
+    handles = _ws_map()
+    with _ws_handles()["lock"]:
+        handles[title] = ws
+    return ws
+
 # ---- Cabeceras esperadas en inscripciones / waitlist ----
 _EXPECTED_HEADERS = ["timestamp","fecha_iso","hora","nombre","canasta","equipo","tutor","telefono","email"]
-
-# ====== CARGA CACHEADA (TTL=60s) ======
-@st.cache_data(ttl=60, show_spinner=False)
-def _load_ws_df_cached(sheet_name: str) -> pd.DataFrame:
-    """Lee una pestaña y la normaliza (cacheada). Evita 429."""
+SESIONES_HEADERS = ["fecha_iso","hora","estado","estado_mini","estado_grande"]
+
+# ====== ESQUEMA (migración única por proceso) ======
+# Subir SCHEMA_VERSION cuando cambien pestañas o cabeceras: la migración se vuelve a ejecutar.
+SCHEMA_VERSION = 1
+_ESQUEMA = {
+    "sesiones": SESIONES_HEADERS,
+    "inscripciones": _EXPECTED_HEADERS,
+    "waitlist": _EXPECTED_HEADERS,
+    "familias": FAMILIAS_HEADERS,
+    "hijos": HIJOS_HEADERS,
+}
+
+def _crear_pestana(title: str):
+    """Crea la pestaña con sus cabeceras del esquema."""
+    headers = _ESQUEMA[title]
+    ws = _add_ws(title, rows=500, cols=len(headers))
+    _retry_gspread(ws.update, f"A1:{chr(64+len(headers))}1", [headers])
+    return ws
+
+@st.cache_resource(show_spinner=False)
+def _migrar_esquema(sheet_id: str, version: int) -> dict:
+    """
+    Migración versionada, UNA vez por proceso y (hoja, versión): crea las pestañas que falten y
+    completa las cabeceras vacías o antiguas (p. ej. 'sesiones' de 3 columnas) con una lectura
+    por lotes de las filas 1 y, si hace falta, una escritura. Devuelve {pestaña: cabeceras}.
+    """
     sh = _open_sheet()
-    ws = sh.worksheet(sheet_name)
-    vals = ws.get_all_values()
-    if not vals:
+    titulos = list(_ESQUEMA)
+    res = _batch_get_ranges(sh, [f"'{t}'!1:1" for t in titulos])
+    estado, data = {}, []
+    for title, vals in zip(titulos, res):
+        headers = _ESQUEMA[title]
+        if vals is None:
+            _crear_pestana(title)
+            estado[title] = list(headers)
+            continue
+        actual = (vals or [[]])[0]
+        if len(actual) < len(headers):
+            # Solo se añaden las columnas que faltan al final; nunca se reescriben las existentes
+            actual = list(actual) + headers[len(actual):]
+            data.append({"range": f"'{title}'!A1:{chr(64+len(actual))}1", "values": [actual]})
+        estado[title] = actual
+    if data:
+        _retry_gspread(sh.values_batch_update, {"valueInputOption": "RAW", "data": data})
+    return {"version": version, "cabeceras": estado}
+
+def _asegurar_esquema() -> dict:
+    return _migrar_esquema(_open_sheet().id, SCHEMA_VERSION)
+
+def _df_from_values(sheet_name: str, vals: list[list]) -> pd.DataFrame:
+    """Convierte los valores crudos de una pestaña en un DataFrame normalizado."""
+    if sheet_name in ("familias", "hijos"):
+        cols = FAMILIAS_HEADERS if sheet_name == "familias" else HIJOS_HEADERS
+        if not vals or len(vals) == 1:
+            return pd.DataFrame(columns=cols)
+    elif not vals:
         if sheet_name == "sesiones":
-            return pd.DataFrame(columns=["fecha_iso","hora","estado","estado_mini","estado_grande"])
+            return pd.DataFrame(columns=SESIONES_HEADERS)
         return pd.DataFrame(columns=_EXPECTED_HEADERS)
     headers = [h.strip() for h in vals[0]]
-    rows = vals[1:] if len(vals) > 1 else []
+    # values_batch_get recorta las celdas vacías al final de cada fila
+    rows = [list(r) + [""] * (len(headers) - len(r)) for r in vals[1:]]
+    rows = [r[:len(headers)] for r in rows]
     df = pd.DataFrame(rows, columns=headers) if headers else pd.DataFrame()
 
-    def _ensure_cols(df: pd.DataFrame) -> pd.DataFrame:
-        for c in _EXPECTED_HEADERS:
-            if c not in df.columns:
-                df[c] = ""
-        return df
-
     # Normalizaciones por tipo de hoja
-    if sheet_name == "sesiones":
-        for c in ["fecha_iso","hora","estado","estado_mini","estado_grande"]:
+    if sheet_name in ("familias", "hijos"):
+        for c in cols:
+            if c not in df.columns: df[c] = ""
+        df["codigo"] = df["codigo"].astype(str).str.strip()
+    elif sheet_name == "sesiones":
+        for c in SESIONES_HEADERS:
             if c not in df.columns:
                 df[c] = ""
-        df["fecha_iso"] = df["fecha_iso"].map(_norm_fecha_iso)
-        df["hora"] = df["hora"].map(_parse_hora_cell)
+        df["fecha_iso"] = _norm_fecha_iso_col(df["fecha_iso"])
+        df["hora"] = _parse_hora_col(df["hora"])
         df["estado"] = df["estado"].replace("", "ABIERTA").str.upper()
         df["estado_mini"] = df["estado_mini"].replace("", "ABIERTA").str.upper()
         df["estado_grande"] = df["estado_grande"].replace("", "ABIERTA").str.upper()
     else:
-        df = _ensure_cols(df)
-        df["fecha_iso"] = df["fecha_iso"].map(_norm_fecha_iso)
-        df["hora"] = df["hora"].map(_parse_hora_cell)
+        for c in _EXPECTED_HEADERS:
+            if c not in df.columns:
+                df[c] = ""
+        df["fecha_iso"] = _norm_fecha_iso_col(df["fecha_iso"])
+        df["hora"] = _parse_hora_col(df["hora"])
         df["canasta"] = df["canasta"].astype(str).str.strip()
     return df
 
-@st.cache_data(ttl=60, show_spinner=False)
-def load_all_data():
-    """Carga TODO una vez (sesiones, inscripciones, waitlist)."""
-    sh = _open_sheet()
-    # Asegura que existe 'sesiones' solo si falta (sin tocar si ya existe)
+def _tab_de_rango(rango: str) -> str:
+    return rango.split("!")[0].strip("'")
+
+def _batch_get_ranges(sh, ranges: list[str]) -> list:
+    """
+    Lee varios rangos A1 en UNA sola llamada (values_batch_get).
+    Devuelve los valores en el mismo orden; los rangos de pestañas que no existen vienen como None.
+    """
     try:
-        ws = sh.worksheet("sesiones")
-        # Si la hoja existe pero es antigua (3 cols), asegura headers de 5 cols
-        headers = ws.row_values(1)
-        if len(headers) < 5:
-            ws.update("A1:E1", [["fecha_iso","hora","estado","estado_mini","estado_grande"]])
-    except WorksheetNotFound:
-        ws = sh.add_worksheet(title="sesiones", rows=100, cols=5)
-        ws.update("A1:E1", [["fecha_iso","hora","estado","estado_mini","estado_grande"]])
+        resp = _retry_gspread(sh.values_batch_get, ranges)
+        existentes = list(ranges)
+    except APIError as e:
+        # Si falta alguna pestaña, Sheets rechaza el lote entero -> repetimos solo con las que existen
+        if "Unable to parse range" not in str(e):
+            raise
+        titulos = set(_ws_map())
+        existentes = [r for r in ranges if _tab_de_rango(r) in titulos]
+        if not existentes:
+            return [None] * len(ranges)
+        resp = _retry_gspread(sh.values_batch_get, existentes)
+    por_rango = {r: vr.get("values", []) for r, vr in zip(existentes, resp.get("valueRanges", []))}
+    return [por_rango.get(r) for r in ranges]
+
+def _batch_get_values(sh, sheet_names: list[str]) -> dict:
+    """Lee varias pestañas completas en UNA sola llamada. {pestaña: valores | None si no existe}"""
+    return dict(zip(sheet_names, _batch_get_ranges(sh, [f"'{n}'" for n in sheet_names])))
+
+# ====== FRESCURA (Drive modifiedTime) ======
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files/{}"
+
+def _drive_version() -> str | None:
+    """
+    Versión actual del fichero según Drive (una llamada mínima de metadatos).
+    Devuelve None si no se puede consultar (API de Drive no habilitada, error puntual): entonces se
+    sigue sirviendo el snapshot y se recarga en segundo plano cada SNAPSHOT_REFRESCO_SEG.
+    """
+    try:
+        r = _retry_gspread(
+            _gc().http_client.request, "get", DRIVE_FILES_URL.format(_open_sheet().id),
+            params={"fields": "version,modifiedTime", "supportsAllDrives": "true"},
+        )
+        meta = r.json()
+        return f"{meta.get('version','')}|{meta.get('modifiedTime','')}"
+    except APIError:
+        return None
+
+@st.cache_resource(show_spinner=False)
+def _snapshots() -> dict:
+    """
+    Última lectura buena de cada grupo de pestañas:
+    {"version": versión de Drive (None si la sonda falló), "value": vista publicada (ver _publicar),
+     "raw", "rev": revisión del contenido (ver _nueva_rev),
+     "sucias": pestañas tocadas por una escritura propia que hay que releer,
+     "invalidado": (opcional) escritura propia que no se pudo parchear -> recarga antes de servir,
+     "validado_en": time.time() de la última vez que se comprobó contra Drive,
+     "intentado_en": (opcional) último refresco en segundo plano lanzado}.
+    """
+    return {}
+
+@st.cache_resource(show_spinner=False)
+def _cache_stats() -> Counter:
+    """Contadores (grupo, evento) de las capas de caché, para ver aciertos/fallos en el panel."""
+    return Counter()
+
+def _contar(grupo: str, evento: str):
+    _cache_stats()[(grupo, evento)] += 1
+
+def snapshot_cache_stats() -> dict:
+    """
+    {grupo: {evento: n}}; eventos: acierto, parcial, recarga, sin_sonda, en_curso, parche, sucia,
+    invalidado, servido, segundo_plano, techo.
+    """
+    out = {}
+    for (grupo, evento), n in sorted(_cache_stats().items()):
+        out.setdefault(grupo, {})[evento] = n
+    return out
+
+@st.cache_resource(show_spinner=False)
+def _recargas() -> dict:
+    """
+    Un lock por grupo de pestañas: solo un hilo del proceso sondea/recarga a la vez (single-flight).
+    "en_fondo": grupos con un refresco en segundo plano ya lanzado.
+    """
+    return {"lock": threading.Lock(), "por_clave": {}, "en_fondo": set()}
+
+def _lock_recarga(clave: str) -> threading.Lock:
+    r = _recargas()
+    with r["lock"]:
+        return r["por_clave"].setdefault(clave, threading.Lock())
+
+@st.cache_resource(show_spinner=False)
+def _contador_rev() -> dict:
+    return {"lock": threading.Lock(), "n": 0}
+
+def _nueva_rev() -> int:
+    """
+    Revisión nueva para un snapshot publicado: contador del proceso, nunca se repite aunque se
+    borre la entrada (botón "Refrescar datos"), así las derivadas cacheadas por rev no se reutilizan.
+    """
+    c = _contador_rev()
+    with c["lock"]:
+        c["n"] += 1
+        return c["n"]
+
+def _publicar(clave: str, value, **meta):
+    """
+    Publica una revisión nueva del snapshot: vista de SOLO LECTURA (también sus índices) que se
+    comparte por referencia entre todas las sesiones, sin copias por llamada. value["rev"] es su
+    identificador de versión. Los DataFrames no se deben modificar: quien quiera cambiarlos, .copy().
+    """
+    vista = {k: MappingProxyType(v) if isinstance(v, dict) else v for k, v in value.items()}
+    vista["rev"] = meta["rev"]
+    vista = MappingProxyType(vista)
+    _snapshots()[clave] = {**meta, "value": vista}
+    return vista
 
-    sesiones = _load_ws_df_cached("sesiones")
+def _leer_si_cambio(clave: str, loader, esperar: bool = False, releer: set | None = None):
+    """
+    Antes de descargar nada pregunta a Drive si el fichero ha cambiado.
+    Si no ha cambiado, se reutiliza (y se prolonga) el snapshot anterior; si solo hay pestañas
+    marcadas como sucias por escrituras propias, el loader relee únicamente esas.
+    Si otro hilo ya está recargando ese grupo, se sirve el snapshot anterior sin esperar;
+    con esperar=True (quien necesita datos frescos) se espera a que termine y se revalida.
+    `releer`: pestañas que hay que volver a leer aunque Drive no indique cambios.
+    """
+    _asegurar_esquema()  # no-op salvo la primera vez en el proceso
+    snaps = _snapshots()
+    lock = _lock_recarga(clave)
+    if not lock.acquire(blocking=False):
+        prev = snaps.get(clave)
+        if prev and not esperar:
+            _contar(clave, "en_curso")
+            return prev["value"]
+        lock.acquire()
     try:
-        ins = _load_ws_df_cached("inscripciones")
-    except WorksheetNotFound:
-        ins = pd.DataFrame(columns=_EXPECTED_HEADERS)
+        validado_en = time.time()
+        version = _drive_version()  # se lee ANTES de cargar: un cambio a mitad forzará recarga luego
+        if version is None:
+            _contar(clave, "sin_sonda")
+        prev = snaps.get(clave)
+        al_dia = bool(version and prev and not prev.get("invalidado") and prev["version"] == version)
+        sucias = set(prev.get("sucias", ())) | set(releer or ()) if prev else set()
+        if al_dia and not sucias:
+            _contar(clave, "acierto")
+            prev["validado_en"] = validado_en
+            return prev["value"]
+        solo = sucias if al_dia else None
+        _contar(clave, "parcial" if solo else "recarga")
+        value, raw = loader(prev, solo)
+        return _publicar(clave, value, version=version, raw=raw, validado_en=validado_en,
+                         rev=_nueva_rev(), sucias=set())
+    finally:
+        lock.release()
+
+def _invalidar_datos():
+    """
+    Tras escribir: fuerza que la próxima lectura vuelva a Sheets (solo se leerán las filas nuevas).
+    Es una marca aparte de version=None, que solo significa que la sonda de Drive falló.
+    """
+    prev = _snapshots().get("core")
+    if prev:
+        prev["invalidado"] = True
+
+@st.cache_resource(show_spinner=False)
+def _parches_lock() -> threading.Lock:
+    """Serializa los parches del snapshot 'core' dentro del proceso (evita perder uno de dos)."""
+    return threading.Lock()
+
+def _escribir_y_parchear(escribir, parche, pestanas: set[str]):
+    """
+    Escritura con parcheo del snapshot en memoria en lugar de invalidarlo: si el snapshot estaba al
+    día justo antes de escribir, se le aplica el cambio y se publica en seguida. Se conserva la versión
+    de Drive de ANTES de escribir: entre las dos sondas puede haber cambiado algo más (edición a mano,
+    otro worker, el retraso de modifiedTime), así que la siguiente sonda hará una recarga barata
+    (filas nuevas de las pestañas append-only + sesiones). Si el parche no es seguro, solo se marcan como
+    sucias las `pestanas` tocadas (la próxima carga relee esas y nada más); si el snapshot ya estaba
+    desfasado, se invalida entero.
+    parche(value, raw, resp) -> (value, raw) nuevos (sin mutar los anteriores) o None.
+    """
+    with _parches_lock():
+        snaps = _snapshots()
+        prev = snaps.get("core")
+        version = _drive_version()
+        al_dia = bool(prev and not prev.get("invalidado") and prev["version"] and prev["version"] == version)
+        resp = escribir()
+        if not al_dia:
+            _contar("core", "invalidado")
+            _invalidar_datos()
+            return resp
+        sucias = set(prev.get("sucias", ()))
+        # Un parche sobre una pestaña que ya está sucia partiría de datos viejos
+        nuevo = parche(prev["value"], prev["raw"], resp) if parche and not (sucias & pestanas) else None
+        if nuevo is None:
+            _contar("core", "sucia")
+            value, raw, rev = prev["value"], prev["raw"], prev.get("rev", 0)
+            sucias |= pestanas
+        else:
+            _contar("core", "parche")
+            (value, raw), rev = nuevo, _nueva_rev()
+        _publicar("core", value, version=version, raw=raw, rev=rev, sucias=sucias, validado_en=time.time())
+    return resp
+
+def _fila_inicial(rango: str) -> int | None:
+    """Primera fila de un rango A1 devuelto por la API ('hoja'!A12:I12 -> 12)."""
+    m = re.search(r"!\$?[A-Z]+\$?(\d+)", rango or "")
+    return int(m.group(1)) if m else None
+
+def _parche_alta(sheet_name: str):
+    """Parche para un append en inscripciones/waitlist: fila nueva + índices de ocupación y nombres."""
+    def parche(value, raw, resp):
+        key = _APPEND_ONLY.get(sheet_name)
+        rows = (raw or {}).get("tabs", {}).get(sheet_name)
+        upd = (resp or {}).get("updates") or {}
+        nueva = ((upd.get("updatedData") or {}).get("values") or [None])[0]
+        # Solo si la fila ha caído justo detrás de las que conocemos (nadie más ha escrito por medio)
+        if not key or not rows or not rows[0] or nueva is None or _fila_inicial(upd.get("updatedRange")) != len(rows) + 1:
+            return None
+        nueva = _trim_row(nueva, len(rows[0]))
+        df_nueva = _df_from_values(sheet_name, [rows[0], nueva])
+        vacio = df_nueva.iloc[0:0]
+        value = dict(value)
+        value[key] = pd.concat([value[key], df_nueva], ignore_index=True)
+        ocupacion = dict(value["ocupacion"])
+        for k, (c, e) in _indice_ocupacion(df_nueva if key == "ins" else vacio, df_nueva if key == "wl" else vacio).items():
+            c0, e0 = ocupacion.get(k, (0, 0))
+            ocupacion[k] = (c0 + c, e0 + e)
+        value["ocupacion"] = ocupacion
+        nombres = dict(value["nombres_idx"])
+        for f, h, n in zip(df_nueva["fecha_iso"], df_nueva["hora"], df_nueva["nombre"]):
+            d = nombres[(f, h)] = dict(nombres.get((f, h), {}))
+            if sheet_name == "inscripciones":
+                d[_norm_name(n)] = "inscripciones"  # manda inscripciones
+            else:
+                d.setdefault(_norm_name(n), "waitlist")
+        value["nombres_idx"] = nombres
+        return value, {**raw, "tabs": {**raw["tabs"], sheet_name: rows + [nueva]}}
+    return parche
+
+def _con_sesiones(value: dict, df: pd.DataFrame) -> dict:
+    """Copia del snapshot con otra tabla de sesiones y sus índices recalculados (la pestaña es pequeña)."""
+    value = dict(value)
+    value["sesiones"] = df
+    value["sesion_idx"] = _indice_sesiones(df)
+    value["sesion_filas"] = _indice_filas_sesiones(df)
+    return value
+
+def _parche_sesiones_nuevas(filas_valores: list[list]):
+    """Parche para un append en 'sesiones' (si las filas han quedado contiguas a las conocidas)."""
+    def parche(value, raw, resp):
+        df = value["sesiones"]
+        upd = (resp or {}).get("updates") or {}
+        if _fila_inicial(upd.get("updatedRange")) != len(df) + 2:
+            return None
+        nuevas = _df_from_values("sesiones", [SESIONES_HEADERS] + filas_valores)
+        return _con_sesiones(value, pd.concat([df, nuevas], ignore_index=True)), raw
+    return parche
+
+def _parche_estados(filas: dict, cambios: dict):
+    """Parche para cambios de estado en filas ya conocidas por el snapshot ({(f, h): fila})."""
+    def parche(value, raw, resp):
+        if any(value["sesion_filas"].get(k) != fila for k, fila in filas.items()):
+            return None
+        df = value["sesiones"].copy()
+        for fila in set(filas.values()):
+            for col, v in cambios.items():
+                df.iat[fila - 2, df.columns.get_loc(col)] = v
+        return _con_sesiones(value, df), raw
+    return parche
+
+def _invalidar_familias():
+    _snapshots().pop("familias", None)
+
+# ====== SNAPSHOT COMPARTIDO (sin copias por llamada) ======
+# Stale-while-revalidate: las páginas sirven el snapshot vigente y, si tiene más de
+# SNAPSHOT_REFRESCO_SEG, lo revalida un hilo en segundo plano. Solo se bloquea en la primera
+# carga, tras una escritura propia o si se supera el techo SNAPSHOT_MAX_STALE_SEG. Si la sonda de
+# Drive falla (version None) no se bloquea: ese hilo recarga, como mucho una vez por intervalo.
+SNAPSHOT_REFRESCO_SEG = 30
+SNAPSHOT_MAX_STALE_SEG = 5 * 60
+
+def _refrescar_en_segundo_plano(clave: str, loader):
     try:
-        wl = _load_ws_df_cached("waitlist")
-    except WorksheetNotFound:
-        wl = pd.DataFrame(columns=_EXPECTED_HEADERS)
-    return {"sesiones": sesiones, "ins": ins, "wl": wl}
+        _leer_si_cambio(clave, loader)
+    except Exception:
+        pass  # se reintenta en el siguiente refresco; el techo de antigüedad obliga a recargar
+    finally:
+        r = _recargas()
+        with r["lock"]:
+            r["en_fondo"].discard(clave)
+
+def _snapshot_swr(clave: str, loader):
+    """Snapshot del grupo sin esperar a Google salvo que no haya uno utilizable."""
+    prev = _snapshots().get(clave)
+    if not prev or prev.get("invalidado") or prev.get("sucias"):
+        return _leer_si_cambio(clave, loader)
+    ahora = time.time()
+    if ahora - prev.get("validado_en", 0) > SNAPSHOT_MAX_STALE_SEG:
+        _contar(clave, "techo")
+        return _leer_si_cambio(clave, loader, esperar=True)
+    # "intentado_en": un refresco fallido no se reintenta en cada rerun, sino al siguiente intervalo
+    if ahora - max(prev.get("validado_en", 0), prev.get("intentado_en", 0)) > SNAPSHOT_REFRESCO_SEG:
+        _open_sheet()  # conexión resuelta aquí: el hilo no tiene contexto de Streamlit
+        r = _recargas()
+        with r["lock"]:
+            lanzar = clave not in r["en_fondo"]
+            r["en_fondo"].add(clave)
+        if lanzar:
+            prev["intentado_en"] = ahora
+            _contar(clave, "segundo_plano")
+            threading.Thread(target=_refrescar_en_segundo_plano, args=(clave, loader), daemon=True).start()
+    _contar(clave, "servido")
+    return prev["value"]
+
+def load_all_data():
+    """
+    Snapshot de sesiones, inscripciones y waitlist (+ índices), de solo lectura y compartido:
+    llamarla muchas veces por rerun no copia nada. Solo descarga si la hoja cambió.
+    """
+    return _snapshot_swr("core", _fetch_all_data)
+
+# ---- Carga incremental de pestañas que solo crecen (append_row) ----
+_APPEND_ONLY = {"inscripciones": "ins", "waitlist": "wl"}
+FULL_RELOAD_SECONDS = 15 * 60  # red de seguridad: ediciones a mano en filas intermedias
+
+def _trim_row(row: list, width: int) -> list:
+    r = [str(c) for c in row[:width]]
+    while r and r[-1] == "":
+        r.pop()
+    return r
+
+def _rangos_cola(title: str, rows: list) -> tuple[list, list]:
+    """
+    Rangos para leer solo lo nuevo de una pestaña de la que ya conocemos `rows`:
+    unas filas de muestra (cabecera, primera, mitad) + desde la última fila conocida hasta el final.
+    """
+    n = len(rows)
+    last_col = chr(64 + len(rows[0]))
+    muestras = sorted({1, min(2, n), max(1, n // 2)})
+    ranges = [f"'{title}'!A{i}:{last_col}{i}" for i in muestras]
+    ranges.append(f"'{title}'!A{n}:{last_col}")
+    return muestras, ranges
+
+def _aplicar_cola(rows: list, muestras: list, vals: list) -> list | None:
+    """Filas nuevas tras la última conocida, o None si la pestaña se ha editado/borrado por medio."""
+    width = len(rows[0])
+    for i, v in zip(muestras, vals):
+        if _trim_row((v or [[]])[0], width) != rows[i - 1]:
+            return None
+    tail = vals[-1] or []
+    if not tail or _trim_row(tail[0], width) != rows[-1]:
+        return None
+    return [_trim_row(r, width) for r in tail[1:]]
 
-@st.cache_data(ttl=300, show_spinner=False)
-def _load_familias_cached() -> pd.DataFrame:
+def _fetch_all_data(prev: dict | None = None, solo: set | None = None) -> tuple[dict, dict]:
+    """
+    Lee sesiones, inscripciones y waitlist con una sola lectura por lotes.
+    Si hay snapshot previo, de inscripciones/waitlist solo se leen las filas nuevas
+    (y unas filas de muestra para detectar borrados o ediciones). Con `solo`, únicamente
+    se leen esas pestañas y el resto se reutiliza del snapshot.
+    """
     sh = _open_sheet()
-    ws = _ensure_ws(sh, "familias", FAMILIAS_HEADERS, cols=len(FAMILIAS_HEADERS))
-    vals = ws.get_all_values()
-    if not vals or len(vals) == 1:
-        return pd.DataFrame(columns=FAMILIAS_HEADERS)
-    df = pd.DataFrame(vals[1:], columns=[h.strip() for h in vals[0]])
-    for c in FAMILIAS_HEADERS:
-        if c not in df.columns: df[c] = ""
-    df["codigo"] = df["codigo"].astype(str).str.strip()
-    return df
+    raw_prev = (prev or {}).get("raw") or {}
+    full = not raw_prev or time.time() - raw_prev["full_at"] > FULL_RELOAD_SECONDS
+    if full:
+        solo = None
+
+    ranges = ["'sesiones'"] if solo is None or "sesiones" in solo else []
+    planes = {}
+    for title in _APPEND_ONLY:
+        if solo is not None and title not in solo:
+            continue
+        rows = None if full else raw_prev["tabs"].get(title)
+        if rows and rows[0]:
+            planes[title] = _rangos_cola(title, rows)
+            ranges += planes[title][1]
+        else:
+            ranges.append(f"'{title}'")
+    res = _batch_get_ranges(sh, ranges) if ranges else []
+
+    # Pestañas y cabeceras ya garantizadas por la migración de esquema
+    if ranges and ranges[0] == "'sesiones'":
+        out = {"sesiones": _df_from_values("sesiones", res[0] or [SESIONES_HEADERS])}
+        pos = 1
+    else:
+        out = {"sesiones": prev["value"]["sesiones"]}
+        pos = 0
+    tabs_raw = {}
+    recargar = []
+    for title, key in _APPEND_ONLY.items():
+        if solo is not None and title not in solo:
+            tabs_raw[title] = raw_prev["tabs"][title]
+            out[key] = prev["value"][key]
+            continue
+        if title not in planes:
+            vals = res[pos] or []
+            pos += 1
+            width = len(vals[0]) if vals else 0
+            tabs_raw[title] = [_trim_row(r, width) for r in vals]
+            out[key] = _df_from_values(title, vals)
+            continue
+        muestras, rs = planes[title]
+        rows = raw_prev["tabs"][title]
+        nuevas = _aplicar_cola(rows, muestras, res[pos:pos + len(rs)])
+        pos += len(rs)
+        if nuevas is None:
+            recargar.append(title)
+            continue
+        tabs_raw[title] = rows + nuevas if nuevas else rows
+        df_prev = prev["value"][key]
+        out[key] = (
+            pd.concat([df_prev, _df_from_values(title, [rows[0]] + nuevas)], ignore_index=True)
+            if nuevas else df_prev
+        )
 
-@st.cache_data(ttl=300, show_spinner=False)
-def _load_hijos_cached() -> pd.DataFrame:
+    # Borrados o ediciones detectados -> recarga completa solo de esas pestañas
+    if recargar:
+        for title, vals in _batch_get_values(sh, recargar).items():
+            vals = vals or []
+            width = len(vals[0]) if vals else 0
+            tabs_raw[title] = [_trim_row(r, width) for r in vals]
+            out[_APPEND_ONLY[title]] = _df_from_values(title, vals)
+
+    raw = {"full_at": time.time() if full else raw_prev["full_at"], "tabs": tabs_raw}
+    return _construir_indices(out), raw
+
+def _construir_indices(data: dict) -> dict:
+    """Índices derivados del snapshot, calculados una vez por carga (no en cada rerun)."""
+    data["ocupacion"] = _indice_ocupacion(data["ins"], data["wl"])
+    data["sesion_idx"] = _indice_sesiones(data["sesiones"])
+    data["sesion_filas"] = _indice_filas_sesiones(data["sesiones"])
+    data["nombres_idx"] = _indice_nombres(data["ins"], data["wl"])
+    return data
+
+def _indice_filas_sesiones(df: pd.DataFrame) -> dict:
+    """(fecha_iso, hora) -> nº de fila en la hoja (cabecera = 1; el DataFrame conserva el orden)."""
+    filas = {}
+    for i, (f, h) in enumerate(zip(df["fecha_iso"], df["hora"]), start=2):
+        filas.setdefault((f, h), i)
+    return filas
+
+def _indice_nombres(ins: pd.DataFrame, wl: pd.DataFrame) -> dict:
+    """(fecha_iso, hora) -> {nombre_normalizado: 'inscripciones' | 'waitlist'}; manda inscripciones."""
+    idx = {}
+    for lista, df in (("inscripciones", ins), ("waitlist", wl)):
+        for f, h, n in zip(df["fecha_iso"], df["hora"], df["nombre"]):
+            idx.setdefault((f, h), {}).setdefault(_norm_name(n), lista)
+    return idx
+
+def _indice_sesiones(df: pd.DataFrame) -> dict:
+    """
+    (fecha_iso, hora) -> estado de la sesión (primera fila si está repetida).
+    Son dicts normales para que los _parche_* puedan copiarlos y ampliarlos (_publicar los expone en solo lectura).
+    """
+    idx = {}
+    for f, h, e, em, eg in zip(df["fecha_iso"], df["hora"], df["estado"], df["estado_mini"], df["estado_grande"]):
+        idx.setdefault((f, h), {
+            "hora": _parse_hora_cell(h),
+            "estado": (str(e) or "ABIERTA").upper(),
+            "estado_mini": (str(em) or "ABIERTA").upper(),
+            "estado_grande": (str(eg) or "ABIERTA").upper(),
+        })
+    return idx
+
+def _indice_ocupacion(ins: pd.DataFrame, wl: pd.DataFrame) -> dict:
+    """(fecha_iso, hora, grupo_canasta) -> (confirmadas, en_espera), con un único groupby."""
+    cols = ["fecha_iso", "hora", "canasta"]
+    both = pd.concat([ins[cols].assign(_lista=0), wl[cols].assign(_lista=1)], ignore_index=True)
+    if both.empty:
+        return {}
+    both["canasta"] = _grupo_canasta_col(both["canasta"])
+    t = both.groupby(cols + ["_lista"]).size().unstack("_lista", fill_value=0)
+    conf = t[0] if 0 in t.columns else pd.Series(0, index=t.index)
+    esp = t[1] if 1 in t.columns else pd.Series(0, index=t.index)
+    return {k: (int(c), int(e)) for k, c, e in zip(t.index, conf, esp)}
+
+def _load_familia_tabs_cached() -> dict:
+    return _snapshot_swr("familias", _fetch_familia_tabs)
+
+def _fetch_familia_tabs(prev: dict | None = None, solo: set | None = None) -> tuple[dict, None]:
+    """Carga 'familias' e 'hijos' juntas en una sola lectura por lotes."""
     sh = _open_sheet()
-    ws = _ensure_ws(sh, "hijos", HIJOS_HEADERS, cols=len(HIJOS_HEADERS))
-    vals = ws.get_all_values()
-    if not vals or len(vals) == 1:
-        return pd.DataFrame(columns=HIJOS_HEADERS)
-    df = pd.DataFrame(vals[1:], columns=[h.strip() for h in vals[0]])
-    for c in HIJOS_HEADERS:
-        if c not in df.columns: df[c] = ""
-    df["codigo"] = df["codigo"].astype(str).str.strip()
-    return df
+    vals = _batch_get_values(sh, ["familias", "hijos"])
+    fam = _df_from_values("familias", vals["familias"] or [FAMILIAS_HEADERS])
+    hij = _df_from_values("hijos", vals["hijos"] or [HIJOS_HEADERS])
+    return {"familias": fam, "hijos": hij, **_indices_familias(fam, hij)}, None
+
+def _indices_familias(fam: pd.DataFrame, hij: pd.DataFrame) -> dict:
+    """
+    Índices hash de familias/hijos (se rehacen solo cuando se recargan las pestañas):
+    código -> última familia, código -> hijos, teléfono -> código de la última familia.
+    """
+    fam_por_codigo, codigo_por_tel = {}, {}
+    for r in fam.to_dict("records"):
+        cod = to_text(r.get("codigo","")).strip()
+        fam_por_codigo[cod.upper()] = {
+            "tutor": to_text(r.get("tutor","")),
+            "telefono": to_text(r.get("telefono","")),
+            "email": to_text(r.get("email","")),
+        }
+        codigo_por_tel[str(r.get("telefono","")).strip()] = cod
+    hijos_por_codigo = {}
+    for r in hij.to_dict("records"):
+        hijos_por_codigo.setdefault(str(r.get("codigo","")).upper(), []).append(r)
+    # Filas en la hoja (1-based, cabecera = 1) para decidir update/append sin releer; gana la primera
+    fila_familia, fila_hijo = {}, {}
+    for i, cod in enumerate(fam["codigo"]):
+        fila_familia.setdefault(str(cod).strip().upper(), i + 2)
+    for i, (cod, jug) in enumerate(zip(hij["codigo"], hij["jugador"])):
+        fila_hijo.setdefault((str(cod).strip().upper(), _norm_name(jug)), i + 2)
+    return {"fam_por_codigo": fam_por_codigo, "hijos_por_codigo": hijos_por_codigo, "codigo_por_tel": codigo_por_tel,
+            "fila_familia": fila_familia, "fila_hijo": fila_hijo}
 
 def get_familia_por_codigo(codigo: str) -> dict | None:
     cod = (codigo or "").strip().upper()
     if not cod:
         return None
-    df = _load_familias_cached()
-    m = df[df["codigo"].str.upper() == cod]
-    if m.empty:
+    fam = _load_familia_tabs_cached()["fam_por_codigo"].get(cod)
+    if not fam:
         return None
-    r = m.iloc[-1].to_dict()
-    return {
-        "codigo": cod,
-        "tutor": to_text(r.get("tutor","")),
-        "telefono": to_text(r.get("telefono","")),
-        "email": to_text(r.get("email","")),
-    }
+    return {"codigo": cod, **fam}
 
 def get_hijos_por_codigo(codigo: str) -> list[dict]:
     cod = (codigo or "").strip().upper()
     if not cod:
         return []
-    df = _load_hijos_cached()
-    m = df[df["codigo"].str.upper() == cod]
-    if m.empty:
-        return []
-    return m.to_dict("records")
+    return [dict(r) for r in _load_familia_tabs_cached()["hijos_por_codigo"].get(cod, [])]
+
+def _peticion_upsert_fila(sheet_id: int, fila: int | None, valores: list) -> dict:
+    """Petición de batch_update: updateCells sobre la fila (1-based) si existe, si no appendCells."""
+    filas = [{"values": [{"userEnteredValue": {"stringValue": str(v)}} for v in valores]}]
+    if fila:
+        rango = {"sheetId": sheet_id, "startRowIndex": fila - 1, "endRowIndex": fila,
+                 "startColumnIndex": 0, "endColumnIndex": len(valores)}
+        return {"updateCells": {"range": rango, "rows": filas, "fields": "userEnteredValue"}}
+    return {"appendCells": {"sheetId": sheet_id, "rows": filas, "fields": "userEnteredValue"}}
+
+def _es_fila_familia(row: list, codigo: str) -> bool:
+    return bool(row) and str(row[0]).strip().upper() == codigo
+
+def _es_fila_hijo(row: list, codigo: str, jugador_n: str) -> bool:
+    return len(row) >= 2 and str(row[0]).strip().upper() == codigo and _norm_name(row[1]) == jugador_n
+
+def _localizar_filas_familia(fam: dict, codigo: str, jugador_n: str) -> tuple[int | None, int | None]:
+    """
+    (fila familia, fila hijo) 1-based para el upsert. Las filas del snapshot se verifican con una
+    sola lectura por lotes de sus celdas clave (filas borradas/reordenadas a mano que Drive aún no
+    ha reflejado); si alguna no cuadra, se busca en la pestaña completa (None -> append).
+    """
+    fila_fam = fam["fila_familia"].get(codigo)
+    fila_hijo = fam["fila_hijo"].get((codigo, jugador_n))
+    rangos = {}
+    if fila_fam:
+        rangos["familias"] = f"'familias'!A{fila_fam}"
+    if fila_hijo:
+        rangos["hijos"] = f"'hijos'!A{fila_hijo}:B{fila_hijo}"
+    if not rangos:
+        return fila_fam, fila_hijo
+    sh = _open_sheet()
+    leidas = dict(zip(rangos, _batch_get_ranges(sh, list(rangos.values()))))
+    rescan = []
+    if fila_fam and not _es_fila_familia((leidas["familias"] or [[]])[0], codigo):
+        rescan.append("familias")
+    if fila_hijo and not _es_fila_hijo((leidas["hijos"] or [[]])[0], codigo, jugador_n):
+        rescan.append("hijos")
+    vals = _batch_get_values(sh, rescan) if rescan else {}
+    # Gana la primera fila, igual que en _indices_familias
+    if "familias" in vals:
+        fila_fam = next((i for i, r in enumerate(vals["familias"] or [], start=1)
+                         if i > 1 and _es_fila_familia(r, codigo)), None)
+    if "hijos" in vals:
+        fila_hijo = next((i for i, r in enumerate(vals["hijos"] or [], start=1)
+                          if i > 1 and _es_fila_hijo(r, codigo, jugador_n)), None)
+    return fila_fam, fila_hijo
 
 def upsert_familia_y_hijo(codigo: str | None, tutor: str, telefono: str, email: str,
                           jugador: str, equipo: str, canasta: str) -> str:
-    sh = _open_sheet()
-    ws_fam = _ensure_ws(sh, "familias", FAMILIAS_HEADERS, cols=len(FAMILIAS_HEADERS))
-    ws_hij = _ensure_ws(sh, "hijos", HIJOS_HEADERS, cols=len(HIJOS_HEADERS))
+    """
+    Alta/actualización de familia (por código) e hijo (por código + jugador) con UNA sola escritura:
+    el índice de filas sale del snapshot de familias y se verifica antes de escribir encima.
+    """
     now = dt.datetime.now().isoformat(timespec="seconds")
 
     tel = (telefono or "").strip()
     if not tel:
         return codigo or ""
 
+    fam = _leer_si_cambio("familias", _fetch_familia_tabs, esperar=True)
+
     # 1) Si no hay código, intentamos reutilizar uno por teléfono (si ya existe)
     if not codigo:
-        df = _load_familias_cached()
-        m = df[df["telefono"].astype(str).str.strip() == tel]
-        if not m.empty:
-            codigo = to_text(m.iloc[-1].get("codigo","")).strip()
+        codigo = fam["codigo_por_tel"].get(tel, "")
 
     # 2) Si sigue sin haber, generamos uno nuevo
     if not codigo:
@@ -421,46 +1096,40 @@ def upsert_familia_y_hijo(codigo: str | None, tutor: str, telefono: str, email:
 
     codigo = codigo.strip().upper()
 
-    # 3) Upsert familia (por código)
-    rows = _retry_gspread(ws_fam.get_all_values)
-    if not rows:
-        _retry_gspread(ws_fam.update, "A1:E1", [FAMILIAS_HEADERS])
-        rows = _retry_gspread(ws_fam.get_all_values)
-
-    updated = False
-    for i, row in enumerate(rows[1:], start=2):
-        if len(row) >= 1 and str(row[0]).strip().upper() == codigo:
-            _retry_gspread(ws_fam.update, f"A{i}:E{i}", [[codigo, tutor, tel, email, now]])
-            updated = True
-            break
-    if not updated:
-        _retry_gspread(ws_fam.append_row, [codigo, tutor, tel, email, now], value_input_option="USER_ENTERED")
-
-    # 4) Upsert hijo (por código + jugador_norm)
-    jugador_norm = _norm_name(jugador)
-    rows2 = _retry_gspread(ws_hij.get_all_values)
-    if not rows2:
-        _retry_gspread(ws_hij.update, "A1:E1", [HIJOS_HEADERS])
-        rows2 = _retry_gspread(ws_hij.get_all_values)
-
-    done = False
-    for i, row in enumerate(rows2[1:], start=2):
-        if len(row) >= 2 and str(row[0]).strip().upper() == codigo and _norm_name(row[1]) == jugador_norm:
-            _retry_gspread(ws_hij.update, f"A{i}:E{i}", [[codigo, jugador, equipo, canasta, now]])
-            done = True
-            break
-    if not done:
-        _retry_gspread(ws_hij.append_row, [codigo, jugador, equipo, canasta, now], value_input_option="USER_ENTERED")
+    # 3) Familia (por código) + 4) hijo (por código + jugador_norm), en el mismo batch_update
+    fila_fam, fila_hijo = _localizar_filas_familia(fam, codigo, _norm_name(jugador))
+    peticiones = [
+        _peticion_upsert_fila(_get_ws("familias").id, fila_fam, [codigo, tutor, tel, email, now]),
+        _peticion_upsert_fila(_get_ws("hijos").id, fila_hijo, [codigo, jugador, equipo, canasta, now]),
+    ]
+    _retry_gspread(_open_sheet().batch_update, {"requests": peticiones})
 
     # invalidar caches
-    _load_familias_cached.clear()
-    _load_hijos_cached.clear()
+    _invalidar_familias()
     return codigo
 
 # ===== app.py (2/5) =====
 # ====== HELPERS EN MEMORIA ======
+@st.cache_resource(show_spinner=False)
+def _derivados() -> dict:
+    """Estructuras derivadas del snapshot (nombre -> (clave, valor)); se rehacen solo si cambia la clave."""
+    return {}
+
+def _por_revision(nombre: str, clave, construir):
+    """Devuelve la derivada `nombre` para `clave` (rev del snapshot + lo que dependa); la construye una vez."""
+    cache = _derivados()
+    hit = cache.get(nombre)
+    if hit and hit[0] == clave:
+        return hit[1]
+    valor = construir()
+    cache[nombre] = (clave, valor)
+    return valor
+
 def get_sesiones_por_dia_cached() -> dict:
-    df = load_all_data()["sesiones"]
+    data = load_all_data()
+    return _por_revision("sesiones_por_dia", data["rev"], lambda: _sesiones_por_dia(data["sesiones"]))
+
+def _sesiones_por_dia(df: pd.DataFrame) -> dict:
     out = {}
     for _, r in df.iterrows():
         f = str(r["fecha_iso"]).strip()
@@ -476,19 +1145,95 @@ def get_sesiones_por_dia_cached() -> dict:
         out.setdefault(f, []).append(item)
     return out
 
+def _estado_col(col: pd.Series) -> pd.Series:
+    v = col.astype(str).str.strip().str.upper()
+    return v.mask(v == "", "ABIERTA")
+
+def get_calendario_mem(hoy: dt.date) -> dict:
+    """
+    Eventos del calendario por día + fechas futuras con alguna sesión ABIERTA.
+    Se calcula una vez por revisión del snapshot (y día): en cada rerun solo es una consulta.
+    """
+    data = load_all_data()
+    return _por_revision("calendario", (data["rev"], hoy), lambda: _construir_calendario(data, hoy))
+
+def _mes_desplazado(mes: dt.date, n: int) -> dt.date:
+    """Primer día del mes `n` meses antes/después de `mes`."""
+    m = mes.year * 12 + mes.month - 1 + n
+    return dt.date(m // 12, m % 12 + 1, 1)
+
+def _rango_visible(mes: dt.date) -> list[str]:
+    """Días que pinta la vista dayGridMonth (semanas de lunes, 6 filas fijas) para ese mes."""
+    inicio = mes - dt.timedelta(days=mes.weekday())
+    return [(inicio + dt.timedelta(days=i)).isoformat() for i in range(42)]
+
+def get_eventos_mes(hoy: dt.date, mes: dt.date) -> list[dict]:
+    """
+    Eventos solo del rango visible del mes (no toda la temporada). Al pedir un mes se dejan
+    también preparados el anterior y el siguiente, para que la navegación no recalcule.
+    """
+    data = load_all_data()
+    por_dia = get_calendario_mem(hoy)["por_dia"]
+    meses = _por_revision("calendario_meses", (data["rev"], hoy), dict)
+    if mes not in meses:
+        for m in (mes, _mes_desplazado(mes, -1), _mes_desplazado(mes, 1)):
+            meses.setdefault(m, [e for f in _rango_visible(m) for e in por_dia.get(f, ())])
+    return meses[mes]
+
+def _construir_calendario(data, hoy: dt.date) -> dict:
+    """Color por día (estado/ocupación, respetando cierres por grupo) y etiquetas de hora, en un groupby."""
+    df = data["sesiones"]
+    ses = pd.DataFrame({
+        "fecha_iso": df["fecha_iso"].astype(str).str.strip(),
+        "hora": df["hora"].astype(str).str.strip(),
+        "estado": _estado_col(df["estado"]),
+        "estado_mini": _estado_col(df["estado_mini"]),
+        "estado_grande": _estado_col(df["estado_grande"]),
+    })
+    ses = ses[ses["fecha_iso"] != ""]
+    ses["dia"] = pd.to_datetime(ses["fecha_iso"], errors="coerce").dt.date
+    ses = ses[ses["dia"].notna()]
+    if ses.empty:
+        return {"por_dia": {}, "abiertas": []}
+
+    # Plazas por grupo con el estado de la primera fila de cada sesión (igual que plazas_libres_mem)
+    prim = ses.drop_duplicates(["fecha_iso", "hora"])
+    ocupacion = data["ocupacion"]
+    claves = list(zip(prim["fecha_iso"], prim["hora"]))
+    mini, grande = _grupo_canasta(CATEG_MINI), _grupo_canasta(CATEG_GRANDE)
+    conf_mini = pd.Series([ocupacion.get((f, h, mini), (0, 0))[0] for f, h in claves], index=prim.index)
+    conf_grande = pd.Series([ocupacion.get((f, h, grande), (0, 0))[0] for f, h in claves], index=prim.index)
+    cerrada = prim["estado"] == "CERRADA"
+    libre_mini = ~cerrada & (prim["estado_mini"] != "CERRADA") & (conf_mini < MAX_POR_CANASTA)
+    libre_grande = ~cerrada & (prim["estado_grande"] != "CERRADA") & (conf_grande < MAX_POR_CANASTA)
+    prim = prim.assign(algun_lleno=~(libre_mini & libre_grande), todo_lleno=~(libre_mini | libre_grande))
+
+    abierta = (ses["estado"] == "ABIERTA").groupby(ses["fecha_iso"]).any()
+    por_dia = prim.groupby("fecha_iso").agg(dia=("dia", "first"), algun_lleno=("algun_lleno", "any"),
+                                            todo_lleno=("todo_lleno", "all"))
+    por_dia["abierta"] = abierta
+    pasada = por_dia["dia"] < hoy
+    color = pd.Series("#28a745", index=por_dia.index)
+    color = color.mask(por_dia["algun_lleno"], "#ffc107").mask(por_dia["todo_lleno"], "#dc3545")
+    color = color.mask(~por_dia["abierta"], "#fd7e14").mask(pasada, "#dc3545")
+
+    fondo = color[por_dia["dia"] != hoy]
+    eventos = {f: [{"title": "", "start": f, "end": f, "display": "background", "backgroundColor": c}]
+               for f, c in fondo.items()}
+    # Etiquetas "HH:MM–HH:MM" por sesión, ordenadas por fecha y hora (hora_mas solo sobre horas únicas)
+    horas = ses.sort_values(["fecha_iso", "hora"], kind="stable")
+    ini = {h: _parse_hora_cell(h or "—") for h in horas["hora"].unique()}
+    etiqueta = {h: f"{i}–{hora_mas(i, 60)}" for h, i in ini.items()}
+    for f, h in zip(horas["fecha_iso"], horas["hora"]):
+        eventos.setdefault(f, []).append({"title": etiqueta[h], "start": f, "end": f, "display": "auto"})
+    abiertas = sorted(por_dia.index[por_dia["abierta"] & ~pasada])
+    return {"por_dia": eventos, "abiertas": abiertas}
+
 def get_sesion_info_mem(fecha_iso: str, hora: str) -> dict:
-    df = load_all_data()["sesiones"]
     h = _parse_hora_cell(hora)
-    f = _norm_fecha_iso(fecha_iso)
-    m = df[(df["fecha_iso"] == f) & (df["hora"] == h)]
-    if not m.empty:
-        r = m.iloc[0].to_dict()
-        return {
-            "hora": _parse_hora_cell(r.get("hora","—")),
-            "estado": (str(r.get("estado","ABIERTA")) or "ABIERTA").upper(),
-            "estado_mini": (str(r.get("estado_mini","ABIERTA")) or "ABIERTA").upper(),
-            "estado_grande": (str(r.get("estado_grande","ABIERTA")) or "ABIERTA").upper(),
-        }
+    info = load_all_data()["sesion_idx"].get((_norm_fecha_iso(fecha_iso), h))
+    if info:
+        return dict(info)
     return {"hora": h, "estado": "ABIERTA", "estado_mini": "ABIERTA", "estado_grande": "ABIERTA"}
 
 def _inscripciones_mem(fecha_iso: str, hora: str) -> pd.DataFrame:
@@ -518,6 +1263,20 @@ def _match_canasta(valor: str, objetivo: str) -> bool:
         return v.startswith("canasta")
     return v == o
 
+def _grupo_canasta(valor: str) -> str:
+    """Clave de grupo equivalente a _match_canasta: 'mini', 'canasta' o el valor tal cual."""
+    v = (valor or "").strip().lower()
+    if v.startswith("mini"):
+        return "mini"
+    if v.startswith("canasta"):
+        return "canasta"
+    return v
+
+def _grupo_canasta_col(col: pd.Series) -> pd.Series:
+    v = col.astype(str).str.strip().str.lower()
+    v = v.mask(v.str.startswith("mini"), "mini")
+    return v.mask(v.str.startswith("canasta"), "canasta")
+
 def get_estado_grupo_mem(fecha_iso: str, hora: str, canasta: str) -> str:
     info = get_sesion_info_mem(fecha_iso, hora)
     # Si global cerrada -> todo cerrado
@@ -529,10 +1288,9 @@ def get_estado_grupo_mem(fecha_iso: str, hora: str, canasta: str) -> str:
     return (info.get("estado_grande","ABIERTA") or "ABIERTA").upper()
 
 def plazas_ocupadas_mem(fecha_iso: str, hora: str, canasta: str) -> int:
-    df_ins = _inscripciones_mem(fecha_iso, hora)
-    if df_ins.empty:
-        return 0
-    return sum(1 for _, r in df_ins.iterrows() if _match_canasta(r.get("canasta",""), canasta))
+    ocupacion = load_all_data()["ocupacion"]
+    clave = (_norm_fecha_iso(fecha_iso), _parse_hora_cell(hora), _grupo_canasta(canasta))
+    return ocupacion.get(clave, (0, 0))[0]
 
 def plazas_libres_mem(fecha_iso: str, hora: str, canasta: str) -> int:
     # Respeta cierre por grupo + global
@@ -541,129 +1299,320 @@ def plazas_libres_mem(fecha_iso: str, hora: str, canasta: str) -> int:
     return max(0, MAX_POR_CANASTA - plazas_ocupadas_mem(fecha_iso, hora, canasta))
 
 def ya_existe_en_sesion_mem(fecha_iso: str, hora: str, nombre: str) -> str | None:
-    nn = _norm_name(nombre)
-    for _, r in _inscripciones_mem(fecha_iso, hora).iterrows():
-        if _norm_name(r.get("nombre","")) == nn:
-            return "inscripciones"
-    for _, r in _waitlist_mem(fecha_iso, hora).iterrows():
-        if _norm_name(r.get("nombre","")) == nn:
-            return "waitlist"
-    return None
+    nombres = load_all_data()["nombres_idx"].get((_norm_fecha_iso(fecha_iso), _parse_hora_cell(hora)), {})
+    return nombres.get(_norm_name(nombre))
+
+# ====== LIMITADOR DE CUOTA (token bucket por proceso) ======
+# Cuota de Sheets: 60 lecturas y 60 escrituras por minuto y usuario (la service account).
+# En cualquier ventana de 60 s caben como mucho RAFAGA + CUOTA_POR_MINUTO llamadas (el cubo lleno
+# más lo que se rellena), así que la suma se deja por debajo de 60. Drive va aparte (cuota mucho mayor).
+CUOTA_POR_MINUTO = {"lectura": 50, "escritura": 50, "drive": 600}  # ritmo de recarga
+RAFAGA = {"lectura": 8, "escritura": 8, "drive": 60}  # capacidad del cubo
+_LLAMADAS_ESCRITURA = {
+    "append_row", "append_rows", "update", "update_cell", "batch_update",
+    "values_batch_update", "delete_rows", "add_worksheet",
+}
+
+@st.cache_resource(show_spinner=False)
+def _cubos_cuota() -> dict:
+    """Un cubo de tokens por tipo de llamada, compartido por todas las sesiones del proceso."""
+    ahora = time.monotonic()
+    return {
+        "lock": threading.Lock(),
+        "cubos": {tipo: {"cap": float(RAFAGA[tipo]), "tokens": float(RAFAGA[tipo]), "ritmo": n / 60.0,
+                         "t": ahora, "pausa_hasta": 0.0}
+                  for tipo, n in CUOTA_POR_MINUTO.items()},
+    }
+
+def _tipo_llamada(call) -> str:
+    nombre = getattr(call, "__name__", "")
+    if nombre == "request":
+        return "drive"
+    return "escritura" if nombre in _LLAMADAS_ESCRITURA else "lectura"
+
+def _tomar_token(tipo: str):
+    """Espera (en cola, sin fallar) hasta que haya cupo para una llamada de ese tipo."""
+    q = _cubos_cuota()
+    while True:
+        with q["lock"]:
+            c = q["cubos"][tipo]
+            ahora = time.monotonic()
+            c["tokens"] = min(c["cap"], c["tokens"] + (ahora - c["t"]) * c["ritmo"])
+            c["t"] = ahora
+            espera = c["pausa_hasta"] - ahora
+            if espera <= 0:
+                if c["tokens"] >= 1:
+                    c["tokens"] -= 1
+                    return
+                espera = (1 - c["tokens"]) / c["ritmo"]
+        time.sleep(espera + random.uniform(0, 0.1))  # jitter: que no despierten todos a la vez
+
+def _pausar_cubo(tipo: str, segundos: float):
+    """Tras un 429 nadie del proceso vuelve a llamar (de ese tipo) hasta pasados `segundos`."""
+    q = _cubos_cuota()
+    with q["lock"]:
+        c = q["cubos"][tipo]
+        c["pausa_hasta"] = max(c["pausa_hasta"], time.monotonic() + segundos)
+        c["tokens"] = 0.0
+
+def _retry_after(e: APIError) -> float | None:
+    try:
+        return max(0.0, float(e.response.headers.get("Retry-After")))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def _backoff(intento: int) -> float:
+    return 1.5 * (2 ** intento) * random.uniform(0.5, 1.0)
 
 # ====== ESCRITURAS CON BACKOFF + INVALIDACIÓN DE CACHÉ ======
 def _retry_gspread(call, *args, **kwargs):
+    tipo = _tipo_llamada(call)
     last_exc = None
     for i in range(5):
+        _tomar_token(tipo)
         try:
             return call(*args, **kwargs)
         except APIError as e:
             last_exc = e
             msg = str(e)
-            # Backoff ante cuotas o 5xx
-            if "429" in msg or "quota" in msg.lower() or "500" in msg or "503" in msg:
-                time.sleep(1.5 * (2 ** i))
+            # Cuota: se pausa el cubo para todo el proceso (respetando Retry-After si viene)
+            if "429" in msg or "quota" in msg.lower():
+                _pausar_cubo(tipo, _retry_after(e) or _backoff(i))
+                continue
+            # 5xx: backoff con jitter solo para esta llamada
+            if "500" in msg or "503" in msg:
+                time.sleep(_backoff(i))
                 continue
             raise
     raise last_exc if last_exc else RuntimeError("Error desconocido en Google Sheets")
 
 def append_row(sheet_name: str, values: list):
-    sh = _open_sheet()
-    ws = sh.worksheet(sheet_name)
-    headers = ws.row_values(1)
-    if not headers:
-        _retry_gspread(ws.update, "A1:I1", [_EXPECTED_HEADERS])
-    _retry_gspread(ws.append_row, values, value_input_option="USER_ENTERED")
-    load_all_data.clear()  # invalidar cache para ver el cambio al instante
+    ws = _get_ws(sheet_name)  # cabeceras garantizadas por la migración de esquema
+    # La respuesta trae la fila tal como la guarda Sheets: con ella se parchea el snapshot
+    _escribir_y_parchear(
+        lambda: _retry_gspread(ws.append_row, values, value_input_option="USER_ENTERED",
+                               include_values_in_response=True),
+        _parche_alta(sheet_name),
+        {sheet_name},
+    )
+
+# ====== MOTOR DE RESERVAS (serializado por sesión y canasta) ======
+# Con varios workers, BOOKING_LOCK_DIR (secret o variable de entorno) activa además un lock de
+# fichero en ese directorio compartido; sin él basta el lock del proceso.
+BOOKING_LOCK_DIR = read_secret("BOOKING_LOCK_DIR")
+
+@st.cache_resource(show_spinner=False)
+def _locks_reserva() -> dict:
+    """Un lock por (fecha_iso, hora, grupo de canasta), compartido por todas las sesiones del proceso."""
+    return {"lock": threading.Lock(), "por_clave": {}}
+
+@contextmanager
+def _reserva_serializada(clave: tuple):
+    locks = _locks_reserva()
+    with locks["lock"]:
+        lock = locks["por_clave"].setdefault(clave, threading.Lock())
+    with lock:
+        if not (BOOKING_LOCK_DIR and fcntl):
+            yield
+            return
+        nombre = hashlib.sha1("|".join(clave).encode("utf-8")).hexdigest()[:16]
+        with open(os.path.join(BOOKING_LOCK_DIR, f"reserva_{nombre}.lock"), "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+def _revalidar_altas() -> dict:
+    """
+    Snapshot con inscripciones/waitlist al día (solo sus filas nuevas) y la pestaña de sesiones releída
+    en el mismo lote: un cierre hecho a mano que Drive aún no refleja también cuenta antes de reservar.
+    """
+    return _leer_si_cambio("core", _fetch_all_data, esperar=True, releer=set(_APPEND_ONLY) | {SESIONES_SHEET})
+
+def reservar(row: list) -> str:
+    """
+    Reserva con la fila completa (orden de _EXPECTED_HEADERS). Serializada por (fecha, hora, canasta):
+    revalida contra la cola y el estado de la sesión recién leídos y escribe en inscripciones o en waitlist.
+    Devuelve "ok", "wait", o sin escribir nada: "inscrito", "en_espera", "cerrada".
+    """
+    r = dict(zip(_EXPECTED_HEADERS, row))
+    f, h = _norm_fecha_iso(r["fecha_iso"]), _parse_hora_cell(r["hora"])
+    grupo = _grupo_canasta(r["canasta"])
+    with _reserva_serializada((f, h, grupo)):
+        data = _revalidar_altas()
+        info = data["sesion_idx"].get((f, h), {})
+        col = "estado_mini" if _match_canasta(r["canasta"], CATEG_MINI) else "estado_grande"
+        if "CERRADA" in (info.get("estado"), info.get(col)):
+            return "cerrada"
+        ya = data["nombres_idx"].get((f, h), {}).get(_norm_name(r["nombre"]))
+        if ya:
+            return "inscrito" if ya == "inscripciones" else "en_espera"
+        confirmadas = data["ocupacion"].get((f, h, grupo), (0, 0))[0]
+        if confirmadas < MAX_POR_CANASTA:
+            append_row("inscripciones", row)
+            return "ok"
+        append_row("waitlist", row)
+        return "wait"
 
 SESIONES_SHEET = "sesiones"
 
+def _es_fila_sesion(row: list, f_iso: str, hora_n: str) -> bool:
+    return len(row) >= 2 and _norm_fecha_iso(row[0]) == f_iso and _parse_hora_cell(row[1]) == hora_n
+
+def _localizar_sesiones(ws, claves: list[tuple[str, str]]) -> dict:
+    """
+    {(fecha_iso, hora): fila 1-based} de las sesiones pedidas que existen, SIN descargar la pestaña:
+    las filas salen del índice del snapshot y se verifican todas con una sola lectura por lotes.
+    Si el snapshot está desfasado (filas movidas, o sesiones ausentes y la hoja ha cambiado
+    desde la carga), se cae a la búsqueda completa.
+    """
+    load_all_data()  # garantiza snapshot cargado
+    snap = _snapshots().get("core")
+    filas = {}
+    pendientes = list(dict.fromkeys(claves))
+    if snap:
+        idx = snap["value"]["sesion_filas"]
+        con_fila = [k for k in pendientes if k in idx]
+        if con_fila:
+            vals = _batch_get_ranges(_open_sheet(), [f"'{SESIONES_SHEET}'!A{idx[k]}:B{idx[k]}" for k in con_fila])
+            for k, v in zip(con_fila, vals):
+                if _es_fila_sesion((v or [[]])[0], *k):
+                    filas[k] = idx[k]
+        pendientes = [k for k in pendientes if k not in filas]
+        if not pendientes:
+            return filas
+        if (all(k not in idx for k in pendientes) and SESIONES_SHEET not in snap.get("sucias", ())
+                and not snap.get("invalidado") and snap["version"] and snap["version"] == _drive_version()):
+            return filas  # snapshot al día: las que faltan no existen
+    primera = {}
+    for i, row in enumerate(_retry_gspread(ws.get_all_values)[1:], start=2):
+        if len(row) >= 2:
+            primera.setdefault((_norm_fecha_iso(row[0]), _parse_hora_cell(row[1])), i)
+    for k in pendientes:
+        if k in primera:
+            filas[k] = primera[k]
+    return filas
+
+def _localizar_sesion(ws, f_iso: str, hora_n: str) -> int | None:
+    return _localizar_sesiones(ws, [(f_iso, hora_n)]).get((f_iso, hora_n))
+
 def upsert_sesion(fecha_iso: str, hora: str, estado: str = "ABIERTA", estado_mini: str = "ABIERTA", estado_grande: str = "ABIERTA"):
-    sh = _open_sheet()
     try:
-        ws = sh.worksheet(SESIONES_SHEET)
+        ws = _get_ws(SESIONES_SHEET)
     except WorksheetNotFound:
-        ws = sh.add_worksheet(title="sesiones", rows=100, cols=5)
-        _retry_gspread(ws.update, "A1:E1", [["fecha_iso","hora","estado","estado_mini","estado_grande"]])
-
-    rows = _retry_gspread(ws.get_all_values)
-    if not rows:
-        _retry_gspread(ws.update, "A1:E1", [["fecha_iso","hora","estado","estado_mini","estado_grande"]])
-        rows = _retry_gspread(ws.get_all_values)
-
-    # Si headers antiguos (3 cols), actualizamos a 5
-    if rows and len(rows[0]) < 5:
-        _retry_gspread(ws.update, "A1:E1", [["fecha_iso","hora","estado","estado_mini","estado_grande"]])
-        rows = _retry_gspread(ws.get_all_values)
+        ws = _crear_pestana(SESIONES_SHEET)
 
     f_iso = _norm_fecha_iso(fecha_iso)
     hora_n = _parse_hora_cell(hora)
-
-    for i, row in enumerate(rows[1:], start=2):
-        if len(row) >= 2 and _norm_fecha_iso(row[0]) == f_iso and _parse_hora_cell(row[1]) == hora_n:
-            _retry_gspread(ws.update, f"A{i}:E{i}", [[f_iso, hora_n, estado.upper(), estado_mini.upper(), estado_grande.upper()]])
-            load_all_data.clear()
-            return
-
-    _retry_gspread(ws.append_row, [f_iso, hora_n, estado.upper(), estado_mini.upper(), estado_grande.upper()], value_input_option="USER_ENTERED")
-    load_all_data.clear()
+    valores = [f_iso, hora_n, estado.upper(), estado_mini.upper(), estado_grande.upper()]
+
+    fila = _localizar_sesion(ws, f_iso, hora_n)
+    if fila:
+        _escribir_y_parchear(
+            lambda: _retry_gspread(ws.update, f"A{fila}:E{fila}", [valores]),
+            _parche_estados({(f_iso, hora_n): fila}, dict(zip(SESIONES_HEADERS[2:], valores[2:]))),
+            {SESIONES_SHEET},
+        )
+    else:
+        _escribir_y_parchear(
+            lambda: _retry_gspread(ws.append_row, valores, value_input_option="USER_ENTERED"),
+            _parche_sesiones_nuevas([valores]),
+            {SESIONES_SHEET},
+        )
 
 def delete_sesion(fecha_iso: str, hora: str):
-    sh = _open_sheet()
     try:
-        ws = sh.worksheet(SESIONES_SHEET)
+        ws = _get_ws(SESIONES_SHEET)
     except WorksheetNotFound:
         return
-    rows = _retry_gspread(ws.get_all_values)
-    f_iso = _norm_fecha_iso(fecha_iso)
-    hora_n = _parse_hora_cell(hora)
-    for i, row in enumerate(rows[1:], start=2):
-        if len(row) >= 2 and _norm_fecha_iso(row[0]) == f_iso and _parse_hora_cell(row[1]) == hora_n:
-            _retry_gspread(ws.delete_rows, i)
-            load_all_data.clear()
-            return
+    fila = _localizar_sesion(ws, _norm_fecha_iso(fecha_iso), _parse_hora_cell(hora))
+    if fila:
+        # Las filas se desplazan: no se parchea, se relee solo 'sesiones'
+        _escribir_y_parchear(lambda: _retry_gspread(ws.delete_rows, fila), None, {SESIONES_SHEET})
+
+# ====== Calendario recurrente (alta en bloque) ======
+DIAS_SEMANA = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
+# Tope por alta: una temporada real son unas decenas de semanas; más suele ser un año mal tecleado
+MAX_DIAS_CALENDARIO = 366
+MAX_SESIONES_CALENDARIO = 400
+
+def hora_valida(h: str) -> bool:
+    """True si la hora (normalizada) es una hora real HH:MM (rechaza 25:00, 99:99...)."""
+    try:
+        dt.datetime.strptime(_parse_hora_cell(h), "%H:%M")
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def generar_calendario(desde: dt.date, hasta: dt.date, dias_semana: list[int], horas: list[str]) -> list[tuple[str, str]]:
+    """(fecha_iso, hora) de cada día del rango cuyo weekday (0=lunes) esté en dias_semana, para cada hora."""
+    horas_n = list(dict.fromkeys(_parse_hora_cell(h) for h in horas if str(h).strip()))
+    dias = set(dias_semana)
+    out = []
+    d = desde
+    while d <= hasta:
+        if d.weekday() in dias:
+            out.extend((d.isoformat(), h) for h in horas_n)
+        d += dt.timedelta(days=1)
+    return out
 
-def set_estado_sesion(fecha_iso: str, hora: str, estado: str):
-    sh = _open_sheet()
+def crear_sesiones(sesiones: list[tuple[str, str]], estado: str = "ABIERTA",
+                   estado_mini: str = "ABIERTA", estado_grande: str = "ABIERTA") -> int:
+    """
+    Crea en bloque las sesiones que aún no existen (según el snapshot en memoria)
+    con un único append_rows. Devuelve cuántas se han creado.
+    """
+    existentes = load_all_data()["sesion_idx"]
+    claves = [(_norm_fecha_iso(f), _parse_hora_cell(h)) for f, h in sesiones]
+    nuevas = [k for k in dict.fromkeys(claves) if k not in existentes]
+    if not nuevas:
+        return 0
     try:
-        ws = sh.worksheet(SESIONES_SHEET)
+        ws = _get_ws(SESIONES_SHEET)
     except WorksheetNotFound:
-        return
-    rows = _retry_gspread(ws.get_all_values)
-    # headers antiguos -> upgrade
-    if rows and len(rows[0]) < 5:
-        _retry_gspread(ws.update, "A1:E1", [["fecha_iso","hora","estado","estado_mini","estado_grande"]])
-        rows = _retry_gspread(ws.get_all_values)
+        ws = _crear_pestana(SESIONES_SHEET)
+    filas = [[f, h, estado.upper(), estado_mini.upper(), estado_grande.upper()] for f, h in nuevas]
+    _escribir_y_parchear(
+        lambda: _retry_gspread(ws.append_rows, filas, value_input_option="USER_ENTERED"),
+        _parche_sesiones_nuevas(filas),
+        {SESIONES_SHEET},
+    )
+    return len(filas)
 
-    f_iso = _norm_fecha_iso(fecha_iso)
-    hora_n = _parse_hora_cell(hora)
-    for i, row in enumerate(rows[1:], start=2):
-        if len(row) >= 2 and _norm_fecha_iso(row[0]) == f_iso and _parse_hora_cell(row[1]) == hora_n:
-            _retry_gspread(ws.update_cell, i, 3, estado.upper())
-            load_all_data.clear()
-            return
+# Columnas de estado en 'sesiones': C global / D mini / E grande
+_COL_ESTADO = {"estado": "C", "estado_mini": "D", "estado_grande": "E"}
 
-def set_estado_grupo(fecha_iso: str, hora: str, canasta: str, estado: str):
-    sh = _open_sheet()
+def aplicar_estados(sesiones: list[tuple[str, str]], estado: str | None = None,
+                    estado_mini: str | None = None, estado_grande: str | None = None) -> int:
+    """
+    Aplica cualquier combinación de estados (global / mini / grande; None = sin cambios)
+    a una o varias sesiones con UNA sola escritura por lotes. Devuelve cuántas se actualizaron.
+    """
+    cambios = {"estado": estado, "estado_mini": estado_mini, "estado_grande": estado_grande}
+    cambios = {k: v.upper() for k, v in cambios.items() if v}
+    if not sesiones or not cambios:
+        return 0
     try:
-        ws = sh.worksheet(SESIONES_SHEET)
+        ws = _get_ws(SESIONES_SHEET)
     except WorksheetNotFound:
-        return
-    rows = _retry_gspread(ws.get_all_values)
-    if not rows:
-        return
-    # headers antiguos -> upgrade
-    if len(rows[0]) < 5:
-        _retry_gspread(ws.update, "A1:E1", [["fecha_iso","hora","estado","estado_mini","estado_grande"]])
-        rows = _retry_gspread(ws.get_all_values)
+        return 0
+    claves = [(_norm_fecha_iso(f), _parse_hora_cell(h)) for f, h in sesiones]
+    filas = _localizar_sesiones(ws, claves)
+    if not filas:
+        return 0
+    data = [
+        {"range": f"'{SESIONES_SHEET}'!{_COL_ESTADO[k]}{fila}", "values": [[v]]}
+        for fila in sorted(set(filas.values()))
+        for k, v in cambios.items()
+    ]
+    _escribir_y_parchear(
+        lambda: _retry_gspread(_open_sheet().values_batch_update, {"valueInputOption": "USER_ENTERED", "data": data}),
+        _parche_estados(filas, cambios),
+        {SESIONES_SHEET},
+    )
+    return len(filas)
 
-    f_iso = _norm_fecha_iso(fecha_iso)
-    hora_n = _parse_hora_cell(hora)
-    col = 4 if _match_canasta(canasta, CATEG_MINI) else 5  # D mini / E grande
-    for i, row in enumerate(rows[1:], start=2):
-        if len(row) >= 2 and _norm_fecha_iso(row[0]) == f_iso and _parse_hora_cell(row[1]) == hora_n:
-            _retry_gspread(ws.update_cell, i, col, estado.upper())
-            load_all_data.clear()
-            return
 # ===== app.py (3/5) =====
 # ====== PDF: JUSTIFICANTE INDIVIDUAL ======
 def crear_justificante_pdf(datos: dict) -> BytesIO:
@@ -868,9 +1817,13 @@ if show_admin_login:
         # 🔄 Botón de refresco SOLO visible a admin autenticada (por si se quiere forzar)
         with st.sidebar:
             if st.button("🔄 Refrescar datos (limpiar caché)"):
-                st.cache_data.clear()
-                load_all_data.clear()
+                _snapshots().clear()
                 st.success("Caché limpiada.")
+            with st.expander("📈 Cachés"):
+                for nombre, info in norm_cache_stats().items():
+                    st.caption(f"{nombre}: {info.hits} aciertos · {info.misses} fallos · {info.currsize}/{info.maxsize}")
+                for grupo, eventos in snapshot_cache_stats().items():
+                    st.caption(f"snapshot {grupo}: " + " · ".join(f"{n} {ev}" for ev, n in eventos.items()))
 
         dfs = load_all_data()
         df_ses_all = dfs["sesiones"].copy()
@@ -897,44 +1850,50 @@ if show_admin_login:
                     for _, r in df_ses_listables.iterrows()
                 ]))
         
+                infos = {(f, h): get_sesion_info_mem(f, h) for (f, h) in fechas_horas}
                 opciones = {
-                    (f, h): f"{dt.datetime.strptime(f,'%Y-%m-%d').strftime('%d/%m/%Y')}  ·  {h}  ·  GLOBAL: {get_sesion_info_mem(f,h).get('estado','—')} | MINI: {get_sesion_info_mem(f,h).get('estado_mini','—')} | GRANDE: {get_sesion_info_mem(f,h).get('estado_grande','—')}"
-                    for (f, h) in fechas_horas
+                    (f, h): f"{dt.datetime.strptime(f,'%Y-%m-%d').strftime('%d/%m/%Y')}  ·  {h}  ·  GLOBAL: {i.get('estado','—')} | MINI: {i.get('estado_mini','—')} | GRANDE: {i.get('estado_grande','—')}"
+                    for (f, h), i in infos.items()
                 }
         
-                f_h_admin = st.selectbox(
-                    "Selecciona sesión (fecha + hora)",
-                    options=fechas_horas,
-                    format_func=lambda t: opciones.get(t, f"{t[0]} · {t[1]}")
-                )
+                # Fragmento: cambiar de sesión o generar el PDF solo rerunea estas tablas
+                @st.fragment
+                def _inscritos_sesion_admin(fechas_horas: list, opciones: dict):
+                    f_h_admin = st.selectbox(
+                        "Selecciona sesión (fecha + hora)",
+                        options=fechas_horas,
+                        format_func=lambda t: opciones.get(t, f"{t[0]} · {t[1]}")
+                    )
         
-                f_sel, h_sel = f_h_admin
-                ins_f = _inscripciones_mem(f_sel, h_sel).to_dict("records")
-                wl_f = _waitlist_mem(f_sel, h_sel).to_dict("records")
-                df_show = pd.DataFrame(ins_f)
-                df_wl = pd.DataFrame(wl_f)
+                    f_sel, h_sel = f_h_admin
+                    ins_f = _inscripciones_mem(f_sel, h_sel).to_dict("records")
+                    wl_f = _waitlist_mem(f_sel, h_sel).to_dict("records")
+                    df_show = pd.DataFrame(ins_f)
+                    df_wl = pd.DataFrame(wl_f)
         
-                st.write("**Inscripciones:**")
-                st.dataframe(df_show if not df_show.empty else pd.DataFrame(columns=["—"]), use_container_width=True)
+                    st.write("**Inscripciones:**")
+                    st.dataframe(df_show if not df_show.empty else pd.DataFrame(columns=["—"]), use_container_width=True)
         
-                st.write("**Lista de espera:**")
-                st.dataframe(df_wl if not df_wl.empty else pd.DataFrame(columns=["—"]), use_container_width=True)
+                    st.write("**Lista de espera:**")
+                    st.dataframe(df_wl if not df_wl.empty else pd.DataFrame(columns=["—"]), use_container_width=True)
         
-                if st.button("🧾 Generar PDF (inscripciones + lista de espera)"):
-                    try:
-                        pdf = crear_pdf_sesion(f_sel, h_sel)
-                        st.download_button(
-                            label="Descargar PDF",
-                            data=pdf,
-                            file_name=f"sesion_{f_sel}_{_parse_hora_cell(h_sel)}.pdf",
-                            mime="application/pdf"
-                        )
-                    except ModuleNotFoundError:
-                        st.error("Falta el paquete 'reportlab'. Añádelo a requirements.txt (línea: reportlab).")
+                    if st.button("🧾 Generar PDF (inscripciones + lista de espera)"):
+                        try:
+                            pdf = crear_pdf_sesion(f_sel, h_sel)
+                            st.download_button(
+                                label="Descargar PDF",
+                                data=pdf,
+                                file_name=f"sesion_{f_sel}_{_parse_hora_cell(h_sel)}.pdf",
+                                mime="application/pdf"
+                            )
+                        except ModuleNotFoundError:
+                            st.error("Falta el paquete 'reportlab'. Añádelo a requirements.txt (línea: reportlab).")
         
-                st.divider()
-                st.subheader("🧾 Justificante individual (Admin)")
-                # (tu bloque de justificante individual aquí, tal cual)
+                    st.divider()
+                    st.subheader("🧾 Justificante individual (Admin)")
+                    # (tu bloque de justificante individual aquí, tal cual)
+
+                _inscritos_sesion_admin(fechas_horas, opciones)
         
         # ==========================
         # 🗓️ GESTIÓN DE SESIONES (SIEMPRE VISIBLE)
@@ -963,135 +1922,213 @@ if show_admin_login:
                 st.success(f"Sesión {f_iso} {_parse_hora_cell(hora_nueva)} añadida/actualizada (GLOBAL ABIERTA).")
                 st.rerun()
         
+        # --- 2) CALENDARIO RECURRENTE (alta de temporada en una sola escritura) ---
+        with st.expander("📅 Generar calendario de sesiones"):
+            with st.form("form_calendario_admin"):
+                g1, g2 = st.columns(2)
+                with g1:
+                    gen_desde = st.date_input("Desde", value=dt.date.today(), key="gen_desde")
+                with g2:
+                    gen_hasta = st.date_input("Hasta", value=dt.date.today() + dt.timedelta(days=90), key="gen_hasta")
+                gen_dias = st.multiselect(
+                    "Días de la semana",
+                    options=list(range(7)),
+                    default=[5],
+                    format_func=lambda i: DIAS_SEMANA[i],
+                    key="gen_dias"
+                )
+                gen_horas = st.text_input("Horas (HH:MM, separadas por comas)", value="09:30, 11:00", key="gen_horas")
+
+                if st.form_submit_button("📅 Crear sesiones"):
+                    horas = [h.strip() for h in gen_horas.split(",") if h.strip()]
+                    malas = [h for h in horas if not hora_valida(h)]
+                    if gen_hasta < gen_desde:
+                        st.error("La fecha 'Hasta' es anterior a 'Desde'.")
+                    elif (gen_hasta - gen_desde).days >= MAX_DIAS_CALENDARIO:
+                        st.error(f"El rango no puede superar {MAX_DIAS_CALENDARIO} días. Revisa las fechas.")
+                    elif not gen_dias or not horas:
+                        st.error("Elige al menos un día de la semana y una hora.")
+                    elif malas:
+                        st.error(f"Horas no válidas: {', '.join(malas)}")
+                    else:
+                        propuestas = generar_calendario(gen_desde, gen_hasta, gen_dias, horas)
+                        if len(propuestas) > MAX_SESIONES_CALENDARIO:
+                            st.error(f"Se generarían {len(propuestas)} sesiones (máximo {MAX_SESIONES_CALENDARIO} por alta). "
+                                     "Reduce el rango, los días o las horas.")
+                        else:
+                            n = crear_sesiones(propuestas)
+                            st.success(f"{n} sesión(es) creadas ({len(propuestas) - n} ya existían).")
+                            st.rerun()
+        
         # --- Tabla + eliminar sesión (solo si hay sesiones) ---
-        df_ses = load_all_data()["sesiones"].copy()
-        if df_ses.empty:
-            st.info("No hay sesiones creadas todavía.")
-        else:
-            try:
-                df_ses["__f"] = pd.to_datetime(df_ses["fecha_iso"])
-                df_ses["hora"] = df_ses["hora"].apply(_parse_hora_cell)
-                df_ses = df_ses.sort_values(["__f","hora"]).drop(columns="__f")
-            except Exception:
-                pass
+        @st.fragment
+        def _tabla_sesiones_admin():
+            df_ses = load_all_data()["sesiones"].copy()
+            if df_ses.empty:
+                st.info("No hay sesiones creadas todavía.")
+            else:
+                try:
+                    df_ses["__f"] = pd.to_datetime(df_ses["fecha_iso"])
+                    df_ses["hora"] = df_ses["hora"].apply(_parse_hora_cell)
+                    df_ses = df_ses.sort_values(["__f","hora"]).drop(columns="__f")
+                except Exception:
+                    pass
         
-            st.dataframe(df_ses, use_container_width=True)
+                st.dataframe(df_ses, use_container_width=True)
         
-            st.markdown("#### 🗑️ Eliminar sesión")
+                st.markdown("#### 🗑️ Eliminar sesión")
         
-            opciones_ses = [(r["fecha_iso"], _parse_hora_cell(r["hora"])) for _, r in df_ses.iterrows()]
-            opciones_ses = list(dict.fromkeys(opciones_ses))
+                opciones_ses = [(r["fecha_iso"], _parse_hora_cell(r["hora"])) for _, r in df_ses.iterrows()]
+                opciones_ses = list(dict.fromkeys(opciones_ses))
         
-            fdel, hdel = st.selectbox(
-                "Selecciona sesión a eliminar",
-                options=opciones_ses,
-                format_func=lambda t: f"{dt.datetime.strptime(t[0],'%Y-%m-%d').strftime('%d/%m/%Y')} · {_parse_hora_cell(t[1])}",
-                key="sel_delete_session"
-            )
+                fdel, hdel = st.selectbox(
+                    "Selecciona sesión a eliminar",
+                    options=opciones_ses,
+                    format_func=lambda t: f"{dt.datetime.strptime(t[0],'%Y-%m-%d').strftime('%d/%m/%Y')} · {_parse_hora_cell(t[1])}",
+                    key="sel_delete_session"
+                )
         
-            if st.button("🗑️ Eliminar sesión (GLOBAL)", use_container_width=True):
-                delete_sesion(fdel, hdel)
-                st.warning(f"Sesión {fdel} {hdel} eliminada.")
-                st.rerun()
+                if st.button("🗑️ Eliminar sesión (GLOBAL)", use_container_width=True):
+                    delete_sesion(fdel, hdel)
+                    st.warning(f"Sesión {fdel} {hdel} eliminada.")
+                    st.rerun()
+
+        _tabla_sesiones_admin()
         
         # ==========================
         # ⚡ ACCIÓN RÁPIDA (solo si hay sesiones)
         # ==========================
-        st.divider()
-        st.subheader("⚡ Acción rápida")
-        
-        df_ses2 = load_all_data()["sesiones"].copy()
-        if df_ses2.empty:
-            st.info("No hay sesiones para modificar.")
-        else:
-            # (tu bloque de acción rápida tal cual)
-            try:
-                df_ses2["__f"] = pd.to_datetime(df_ses2["fecha_iso"])
-                df_ses2["hora"] = df_ses2["hora"].apply(_parse_hora_cell)
-                df_ses2 = df_ses2.sort_values(["__f","hora"]).drop(columns="__f")
-            except Exception:
-                pass
-        
-            opciones = [(r["fecha_iso"], _parse_hora_cell(r["hora"])) for _, r in df_ses2.iterrows()]
-            opciones = list(dict.fromkeys(opciones))
-        
-            fsel, hsel = st.selectbox(
-                "Selecciona sesión",
-                options=opciones,
-                format_func=lambda t: f"{dt.datetime.strptime(t[0],'%Y-%m-%d').strftime('%d/%m/%Y')} · {_parse_hora_cell(t[1])}",
-                key="sel_action_session"
-            )
+        # Fragmento: elegir sesión/acción solo rerunea este bloque; al aplicar, st.rerun() de toda la app
+        @st.fragment
+        def _acciones_sesiones_admin():
+            st.divider()
+            st.subheader("⚡ Acción rápida")
         
-            # Estados actuales (para mostrar acciones solo si aplican)
-            info = get_sesion_info_mem(fsel, hsel)
-            estado_global = (info.get("estado","ABIERTA") or "ABIERTA").upper()
-            estado_mini = (info.get("estado_mini","ABIERTA") or "ABIERTA").upper()
-            estado_grande = (info.get("estado_grande","ABIERTA") or "ABIERTA").upper()
+            df_ses2 = load_all_data()["sesiones"].copy()
+            if df_ses2.empty:
+                st.info("No hay sesiones para modificar.")
+            else:
+                # (tu bloque de acción rápida tal cual)
+                try:
+                    df_ses2["__f"] = pd.to_datetime(df_ses2["fecha_iso"])
+                    df_ses2["hora"] = df_ses2["hora"].apply(_parse_hora_cell)
+                    df_ses2 = df_ses2.sort_values(["__f","hora"]).drop(columns="__f")
+                except Exception:
+                    pass
         
-            # Opciones base (siempre disponibles)
-            acciones = [
-                "— Selecciona —",
-                "Cerrar solo Minibasket",
-                "Cerrar solo Canasta grande",
-                "Cerrar sesión completa (GLOBAL)",
-            ]
+                opciones = [(r["fecha_iso"], _parse_hora_cell(r["hora"])) for _, r in df_ses2.iterrows()]
+                opciones = list(dict.fromkeys(opciones))
         
-            # Opciones de reabrir SOLO si hace falta
-            if estado_global == "CERRADA":
-                acciones.append("Reabrir sesión completa (GLOBAL)")
-            if estado_mini == "CERRADA":
-                acciones.append("Reabrir solo Minibasket")
-            if estado_grande == "CERRADA":
-                acciones.append("Reabrir solo Canasta grande")
+                fsel, hsel = st.selectbox(
+                    "Selecciona sesión",
+                    options=opciones,
+                    format_func=lambda t: f"{dt.datetime.strptime(t[0],'%Y-%m-%d').strftime('%d/%m/%Y')} · {_parse_hora_cell(t[1])}",
+                    key="sel_action_session"
+                )
         
-            accion = st.selectbox(
-                "Elige acción",
-                options=acciones,
-                index=0,
-                key="sel_action"
-            )
+                # Estados actuales (para mostrar acciones solo si aplican)
+                info = get_sesion_info_mem(fsel, hsel)
+                estado_global = (info.get("estado","ABIERTA") or "ABIERTA").upper()
+                estado_mini = (info.get("estado_mini","ABIERTA") or "ABIERTA").upper()
+                estado_grande = (info.get("estado_grande","ABIERTA") or "ABIERTA").upper()
+        
+                # Opciones base (siempre disponibles)
+                acciones = [
+                    "— Selecciona —",
+                    "Cerrar solo Minibasket",
+                    "Cerrar solo Canasta grande",
+                    "Cerrar sesión completa (GLOBAL)",
+                ]
+        
+                # Opciones de reabrir SOLO si hace falta
+                if estado_global == "CERRADA":
+                    acciones.append("Reabrir sesión completa (GLOBAL)")
+                if estado_mini == "CERRADA":
+                    acciones.append("Reabrir solo Minibasket")
+                if estado_grande == "CERRADA":
+                    acciones.append("Reabrir solo Canasta grande")
+        
+                accion = st.selectbox(
+                    "Elige acción",
+                    options=acciones,
+                    index=0,
+                    key="sel_action"
+                )
         
-            colA, colB = st.columns([1, 2])
-            with colA:
-                aplicar = st.button("✅ Aplicar", use_container_width=True)
-            with colB:
-                st.caption("Cerrar GLOBAL bloquea ambos grupos. Reabrir un grupo pone GLOBAL ABIERTA para que tenga efecto.")
+                colA, colB = st.columns([1, 2])
+                with colA:
+                    aplicar = st.button("✅ Aplicar", use_container_width=True)
+                with colB:
+                    st.caption("Cerrar GLOBAL bloquea ambos grupos. Reabrir un grupo pone GLOBAL ABIERTA para que tenga efecto.")
         
-            if aplicar:
-                if accion == "— Selecciona —":
-                    st.warning("Selecciona una acción primero.")
+                if aplicar:
+                    if accion == "— Selecciona —":
+                        st.warning("Selecciona una acción primero.")
         
-                elif accion == "Cerrar solo Minibasket":
-                    set_estado_grupo(fsel, hsel, CATEG_MINI, "CERRADA")
-                    st.warning("Minibasket CERRADA.")
-                    st.rerun()
+                    elif accion == "Cerrar solo Minibasket":
+                        aplicar_estados([(fsel, hsel)], estado_mini="CERRADA")
+                        st.warning("Minibasket CERRADA.")
+                        st.rerun()
         
-                elif accion == "Cerrar solo Canasta grande":
-                    set_estado_grupo(fsel, hsel, CATEG_GRANDE, "CERRADA")
-                    st.warning("Canasta grande CERRADA.")
-                    st.rerun()
+                    elif accion == "Cerrar solo Canasta grande":
+                        aplicar_estados([(fsel, hsel)], estado_grande="CERRADA")
+                        st.warning("Canasta grande CERRADA.")
+                        st.rerun()
         
-                elif accion == "Cerrar sesión completa (GLOBAL)":
-                    set_estado_sesion(fsel, hsel, "CERRADA")
-                    st.warning("Sesión cerrada (GLOBAL).")
-                    st.rerun()
+                    elif accion == "Cerrar sesión completa (GLOBAL)":
+                        aplicar_estados([(fsel, hsel)], estado="CERRADA")
+                        st.warning("Sesión cerrada (GLOBAL).")
+                        st.rerun()
         
-                elif accion == "Reabrir sesión completa (GLOBAL)":
-                    set_estado_sesion(fsel, hsel, "ABIERTA")
-                    st.success("Sesión ABIERTA (GLOBAL).")
-                    st.rerun()
+                    elif accion == "Reabrir sesión completa (GLOBAL)":
+                        aplicar_estados([(fsel, hsel)], estado="ABIERTA")
+                        st.success("Sesión ABIERTA (GLOBAL).")
+                        st.rerun()
         
-                elif accion == "Reabrir solo Minibasket":
-                    set_estado_sesion(fsel, hsel, "ABIERTA")  # por si global estaba cerrada
-                    set_estado_grupo(fsel, hsel, CATEG_MINI, "ABIERTA")
-                    st.success("Minibasket ABIERTA.")
-                    st.rerun()
+                    elif accion == "Reabrir solo Minibasket":
+                        # GLOBAL ABIERTA por si estaba cerrada, en la misma escritura
+                        aplicar_estados([(fsel, hsel)], estado="ABIERTA", estado_mini="ABIERTA")
+                        st.success("Minibasket ABIERTA.")
+                        st.rerun()
         
-                elif accion == "Reabrir solo Canasta grande":
-                    set_estado_sesion(fsel, hsel, "ABIERTA")
-                    set_estado_grupo(fsel, hsel, CATEG_GRANDE, "ABIERTA")
-                    st.success("Canasta grande ABIERTA.")
-                    st.rerun()
+                    elif accion == "Reabrir solo Canasta grande":
+                        aplicar_estados([(fsel, hsel)], estado="ABIERTA", estado_grande="ABIERTA")
+                        st.success("Canasta grande ABIERTA.")
+                        st.rerun()
+
+                # --- Cambio en bloque: varias sesiones a la vez (una sola escritura) ---
+                st.markdown("#### 🗂️ Cambio en bloque")
+                sel_bloque = st.multiselect(
+                    "Sesiones",
+                    options=opciones,
+                    format_func=lambda t: f"{dt.datetime.strptime(t[0],'%Y-%m-%d').strftime('%d/%m/%Y')} · {_parse_hora_cell(t[1])}",
+                    key="sel_bloque_sesiones"
+                )
+                _SIN_CAMBIOS = "— Sin cambios —"
+                cb1, cb2, cb3 = st.columns(3)
+                with cb1:
+                    nuevo_global = st.selectbox("GLOBAL", [_SIN_CAMBIOS, "ABIERTA", "CERRADA"], key="bloque_global")
+                with cb2:
+                    nuevo_mini = st.selectbox("Minibasket", [_SIN_CAMBIOS, "ABIERTA", "CERRADA"], key="bloque_mini")
+                with cb3:
+                    nuevo_grande = st.selectbox("Canasta grande", [_SIN_CAMBIOS, "ABIERTA", "CERRADA"], key="bloque_grande")
+
+                if st.button("✅ Aplicar a las sesiones seleccionadas", use_container_width=True):
+                    cambios = {
+                        "estado": None if nuevo_global == _SIN_CAMBIOS else nuevo_global,
+                        "estado_mini": None if nuevo_mini == _SIN_CAMBIOS else nuevo_mini,
+                        "estado_grande": None if nuevo_grande == _SIN_CAMBIOS else nuevo_grande,
+                    }
+                    if not sel_bloque:
+                        st.warning("Selecciona al menos una sesión.")
+                    elif not any(cambios.values()):
+                        st.warning("Elige al menos un estado que cambiar.")
+                    else:
+                        n = aplicar_estados(sel_bloque, **cambios)
+                        st.success(f"{n} sesión(es) actualizadas.")
+                        st.rerun()
+
+        _acciones_sesiones_admin()
         
 
 # ===== app.py (PANEL USUARIO ACTUALIZADO) =====
@@ -1136,48 +2173,25 @@ Entrenamientos de alto enfoque en grupos muy reducidos para maximizar el aprendi
     SESIONES_DIA = get_sesiones_por_dia_cached()
     today = dt.date.today()
 
-    # Días con alguna sesión ABIERTA en el futuro (GLOBAL ABIERTA)
-    fechas_disponibles = sorted([
-        f for f, sesiones in SESIONES_DIA.items()
-        if pd.to_datetime(f).date() >= today and any(s["estado"] == "ABIERTA" for s in sesiones)
-    ])
+    # Eventos y días con alguna sesión ABIERTA en el futuro (GLOBAL ABIERTA), una vez por versión del snapshot
+    calendario_mem = get_calendario_mem(today)
+    fechas_disponibles = calendario_mem["abiertas"]
 
-    # Calendario
+    # Calendario: el mes visible lo llevamos nosotros (el componente no avisa al navegar), así
+    # solo se envían los eventos de ese mes y no toda la temporada
     fecha_seleccionada = None
+    mes_actual = today.replace(day=1)
+    mes_cal = st.session_state.setdefault("cal_mes", mes_actual)
     try:
         from streamlit_calendar import calendar
 
-        events = []
-        for f, sesiones in SESIONES_DIA.items():
-            fecha_dt = pd.to_datetime(f).date()
-
-            # Color agregado por día (estado/ocupación) — usa plazas libres ya respetando cierres por grupo
-            if fecha_dt < today:
-                color = "#dc3545"
-            else:
-                any_abierta = any(s["estado"] == "ABIERTA" for s in sesiones)
-                if not any_abierta:
-                    color = "#fd7e14"
-                else:
-                    full_all = True
-                    any_full = False
-                    for s in sesiones:
-                        mm = plazas_libres_mem(f, s["hora"], CATEG_MINI)
-                        gg = plazas_libres_mem(f, s["hora"], CATEG_GRANDE)
-                        if mm > 0 or gg > 0:
-                            full_all = False
-                        if mm <= 0 or gg <= 0:
-                            any_full = True
-                    color = "#dc3545" if full_all else "#ffc107" if any_full else "#28a745"
-
-            if fecha_dt != today:
-                events.append({"title": "", "start": f, "end": f, "display": "background", "backgroundColor": color})
-
-            for s in sorted(sesiones, key=lambda x: _parse_hora_cell(x["hora"])):
-                h_ini = _parse_hora_cell(s["hora"])
-                h_fin = hora_mas(h_ini, 60)
-                label = f"{h_ini}–{h_fin}"
-                events.append({"title": label, "start": f, "end": f, "display": "auto"})
+        c_prev, c_hoy, c_next = st.columns(3)
+        if c_prev.button("◀ Mes anterior", key="cal_prev", use_container_width=True):
+            mes_cal = st.session_state["cal_mes"] = _mes_desplazado(mes_cal, -1)
+        if c_hoy.button("Hoy", key="cal_hoy", use_container_width=True, disabled=mes_cal == mes_actual):
+            mes_cal = st.session_state["cal_mes"] = mes_actual
+        if c_next.button("Mes siguiente ▶", key="cal_next", use_container_width=True):
+            mes_cal = st.session_state["cal_mes"] = _mes_desplazado(mes_cal, 1)
 
         custom_css = """
         .fc-daygrid-day.fc-day-today { background-color: transparent !important; }
@@ -1193,14 +2207,18 @@ Entrenamientos de alto enfoque en grupos muy reducidos para maximizar el aprendi
         """
 
         cal = calendar(
-            events=events,
-            options={"initialView": "dayGridMonth", "height": 600, "locale": "es", "firstDay": 1},
+            events=get_eventos_mes(today, mes_cal),
+            options={"initialView": "dayGridMonth", "initialDate": mes_cal.isoformat(), "height": 600,
+                     "locale": "es", "firstDay": 1,
+                     "headerToolbar": {"left": "", "center": "title", "right": ""}},
             custom_css=custom_css,
-            key="cal_user",
+            callbacks=["eventClick"],
+            key=f"cal_user_{mes_cal:%Y_%m}",
         )
 
-        if cal and cal.get("clickedEvent"):
-            fclicked = cal["clickedEvent"].get("start")[:10]
+        # Respuesta del componente: {"callback": "eventClick", "eventClick": {"event": {...}}}
+        if cal and cal.get("callback") == "eventClick":
+            fclicked = (cal["eventClick"].get("event", {}).get("start") or "")[:10]
             if fclicked in SESIONES_DIA and pd.to_datetime(fclicked).date() >= today:
                 if any(s["estado"] == "ABIERTA" for s in SESIONES_DIA.get(fclicked, [])):
                     fecha_seleccionada = fclicked
@@ -1260,340 +2278,327 @@ Revisa los campos obligatorios o vuelve a intentarlo.
         """)
 
     # =========== Formulario + Tarjeta de éxito ===========
-    placeholder = st.empty()
-    ok_flag = f"ok_{fkey}_{hkey}"
-    ok_data_key = f"ok_data_{fkey}_{hkey}"
-    celebrate_key = f"celebrate_{fkey}_{hkey}"
-
-    # ------------------------------------------------------------------
-    # ✅ 1) TARJETA DE ÉXITO (si ya reservó)
-    # ------------------------------------------------------------------
-    if st.session_state.get(ok_flag):
-        data = st.session_state.get(ok_data_key, {})
-
-        with placeholder.container():
-            if data.get("status") == "ok":
-                st.success("✅ Inscripción realizada correctamente")
-            else:
-                st.info("ℹ️ Te hemos añadido a la lista de espera")
-
-            if data.get("family_code"):
-                st.info(
-                    f"🔐 **Tu código de familia:** `{data.get('family_code')}`\n\n"
-                    "Guárdalo: te servirá para autorrellenar próximas veces."
-                )
+    # Fragmento: escribir en el formulario, cambiar de pestaña o autorrellenar solo rerunea esta zona
+    # (no la portada, el calendario ni los avisos de plazas). Tras reservar, st.rerun() de toda la app.
+    @st.fragment
+    def _zona_reserva(fkey: str, hkey: str, hora_sesion: str):
+        placeholder = st.empty()
+        ok_flag = f"ok_{fkey}_{hkey}"
+        ok_data_key = f"ok_data_{fkey}_{hkey}"
+        celebrate_key = f"celebrate_{fkey}_{hkey}"
+
+        # ------------------------------------------------------------------
+        # ✅ 1) TARJETA DE ÉXITO (si ya reservó)
+        # ------------------------------------------------------------------
+        if st.session_state.get(ok_flag):
+            data = st.session_state.get(ok_data_key, {})
+
+            with placeholder.container():
+                if data.get("status") == "ok":
+                    st.success("✅ Inscripción realizada correctamente")
+                else:
+                    st.info("ℹ️ Te hemos añadido a la lista de espera")
 
-            canasta_data = (data.get("canasta", "") or "").lower()
-            if "mini" in canasta_data and CANAL_MINI_URL:
-                st.info(
-                    "🏀 **Canal exclusivo de MINIBASKET**\n"
-                    f"[Únete aquí para recibir avisos y la encuesta de esta categoría]({CANAL_MINI_URL})"
-                )
-            elif "canasta" in canasta_data and CANAL_GRANDE_URL:
-                st.info(
-                    "⛹️ **Canal exclusivo de CANASTA GRANDE**\n"
-                    f"[Únete aquí para recibir avisos y la encuesta de esta categoría]({CANAL_GRANDE_URL})"
-                )
+                if data.get("family_code"):
+                    st.info(
+                        f"🔐 **Tu código de familia:** `{data.get('family_code')}`\n\n"
+                        "Guárdalo: te servirá para autorrellenar próximas veces."
+                    )
 
-            st.markdown("#### Resumen")
-            col1, col2 = st.columns(2)
-            with col1:
-                st.write(f"**Jugador:** {data.get('nombre','—')}")
-                st.write(f"**Canasta:** {data.get('canasta','—')}")
-                st.write(f"**Categoría/Equipo:** {data.get('equipo','—')}")
-            with col2:
-                st.write(f"**Tutor:** {data.get('tutor','—')}")
-                st.write(f"**Tel.:** {data.get('telefono','—')}")
-                st.write(f"**Email:** {data.get('email','—')}")
+                canasta_data = (data.get("canasta", "") or "").lower()
+                if "mini" in canasta_data and CANAL_MINI_URL:
+                    st.info(
+                        "🏀 **Canal exclusivo de MINIBASKET**\n"
+                        f"[Únete aquí para recibir avisos y la encuesta de esta categoría]({CANAL_MINI_URL})"
+                    )
+                elif "canasta" in canasta_data and CANAL_GRANDE_URL:
+                    st.info(
+                        "⛹️ **Canal exclusivo de CANASTA GRANDE**\n"
+                        f"[Únete aquí para recibir avisos y la encuesta de esta categoría]({CANAL_GRANDE_URL})"
+                    )
 
-            st.divider()
-            pdf = crear_justificante_pdf(data)
-            st.download_button(
-                label="⬇️ Descargar justificante (PDF)",
-                data=pdf,
-                file_name=(
-                    f"justificante_{data.get('fecha_iso','')}_"
-                    f"{_norm_name(data.get('nombre','')).replace(' ','_')}_"
-                    f"{_parse_hora_cell(data.get('hora','')).replace(':','')}.pdf"
-                ),
-                mime="application/pdf",
-                key=f"dl_btn_{fkey}_{hkey}"
-            )
+                st.markdown("#### Resumen")
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.write(f"**Jugador:** {data.get('nombre','—')}")
+                    st.write(f"**Canasta:** {data.get('canasta','—')}")
+                    st.write(f"**Categoría/Equipo:** {data.get('equipo','—')}")
+                with col2:
+                    st.write(f"**Tutor:** {data.get('tutor','—')}")
+                    st.write(f"**Tel.:** {data.get('telefono','—')}")
+                    st.write(f"**Email:** {data.get('email','—')}")
 
-            if st.button("Hacer otra reserva", key=f"otra_{fkey}_{hkey}"):
-                st.session_state.pop(ok_flag, None)
-                st.session_state.pop(ok_data_key, None)
-                st.session_state.pop(f"hijos_{fkey}_{hkey}", None)
-                st.rerun()
+                st.divider()
+                pdf = crear_justificante_pdf(data)
+                st.download_button(
+                    label="⬇️ Descargar justificante (PDF)",
+                    data=pdf,
+                    file_name=(
+                        f"justificante_{data.get('fecha_iso','')}_"
+                        f"{_norm_name(data.get('nombre','')).replace(' ','_')}_"
+                        f"{_parse_hora_cell(data.get('hora','')).replace(':','')}.pdf"
+                    ),
+                    mime="application/pdf",
+                    key=f"dl_btn_{fkey}_{hkey}"
+                )
 
-        # ✅ 2) CELEBRACIÓN
-        if st.session_state.pop(celebrate_key, False) and data.get("status") == "ok":
-            st.toast("✅ Inscripción realizada correctamente", icon="✅")
-            st.balloons()
+                if st.button("Hacer otra reserva", key=f"otra_{fkey}_{hkey}"):
+                    st.session_state.pop(ok_flag, None)
+                    st.session_state.pop(ok_data_key, None)
+                    st.session_state.pop(f"hijos_{fkey}_{hkey}", None)
+                    st.rerun()
 
-    # ------------------------------------------------------------------
-    # ✅ 3) PESTAÑAS (si NO hay ok_flag)
-    # ------------------------------------------------------------------
-    else:
-        # ✅ IMPORTANTE: esto debe estar FUERA de las tabs (lo usan ambas pestañas)
-        codigo_cookie = (cookies.get("family_code") or "").strip()
+            # ✅ 2) CELEBRACIÓN
+            if st.session_state.pop(celebrate_key, False) and data.get("status") == "ok":
+                st.toast("✅ Inscripción realizada correctamente", icon="✅")
+                st.balloons()
 
-        # ✅ Orden dinámico: por defecto MANUAL, salvo si hay cookie -> AUTO primero
-        if codigo_cookie:
-            tab_auto, tab_manual = st.tabs(["🔐 Autorrellenar con código", "✍️ Rellenar manualmente"])
+        # ------------------------------------------------------------------
+        # ✅ 3) PESTAÑAS (si NO hay ok_flag)
+        # ------------------------------------------------------------------
         else:
-            tab_manual, tab_auto = st.tabs(["✍️ Rellenar manualmente", "🔐 Autorrellenar con código"])
-
-        
-        # ==========================================================
-        # ==========================================================
-        # TAB 1: AUTORELLENAR + RESERVA RÁPIDA
-        # ==========================================================
-        with tab_auto:
-            st.markdown("### 🔐 Autorrellenar")
-        
+            # ✅ IMPORTANTE: esto debe estar FUERA de las tabs (lo usan ambas pestañas)
             codigo_cookie = (cookies.get("family_code") or "").strip()
-            gate_key = f"use_cookie_gate_{fkey}_{hkey}"
-        
-            # Gate activo solo si hay cookie y aún no han respondido
-            gate_pending = bool(codigo_cookie) and (gate_key not in st.session_state)
-        
-            if gate_pending:
-                st.write(f"Se ha detectado un código guardado en este dispositivo: `{codigo_cookie}`")
-                st.write("¿Quieres usar el código guardado? Haz doble click")
-        
-                c_yes, c_no = st.columns(2)
-                with c_yes:
-                    if st.button("✅ Sí", key=f"gate_yes_{fkey}_{hkey}", use_container_width=True):
-                        st.session_state[gate_key] = "yes"
-                with c_no:
-                    if st.button("❌ No", key=f"gate_no_{fkey}_{hkey}", use_container_width=True):
-                        st.session_state[gate_key] = "no"
-                        # limpiamos cosas de autorellenar por si acaso
-                        st.session_state.pop(f"hijos_{fkey}_{hkey}", None)
-                        st.session_state.pop(f"autofilled_{fkey}_{hkey}", None)
-        
-                # ✅ NO hacemos st.rerun() aquí.
-                # En el siguiente rerun natural (por el click) ya se renderizará el else.
-        
+
+            # ✅ Orden dinámico: por defecto MANUAL, salvo si hay cookie -> AUTO primero
+            if codigo_cookie:
+                tab_auto, tab_manual = st.tabs(["🔐 Autorrellenar con código", "✍️ Rellenar manualmente"])
             else:
-                # Si dijeron "no", ignoramos la cookie como valor por defecto
-                codigo_cookie_effective = "" if (codigo_cookie and st.session_state.get(gate_key) == "no") else codigo_cookie
-        
-                codigo_familia = st.text_input(
-                    "Código de familia",
-                    value=codigo_cookie_effective,
-                    key=f"family_code_{fkey}_{hkey}",
-                    placeholder="Ej: CBC-7F3KQ9P2..."
-                )
-        
-                # ✅ define esto ANTES de usarlo
-                hijos_cargados = st.session_state.get(f"hijos_{fkey}_{hkey}", [])
-                fam_valida_o_hijos_cargados = bool(hijos_cargados)
-        
-                # --- Layout botones ---
-                col_use, col_forget = st.columns([3, 1], vertical_alignment="center")
-        
-                with col_use:
-                    # Checkbox "recordar" solo si NO hay cookie guardada y ya hay datos cargados
-                 #   mostrar_recordar = (not bool(codigo_cookie_effective)) and bool(fam_valida_o_hijos_cargados)
-                  #  if mostrar_recordar:
-                   #     recordar_dispositivo = st.checkbox("Guardar este código en este dispositivo", value=False)
-                    #else:
-                     #   recordar_dispositivo = False
-        
-                    # ✅ Botón "Usar este código":
-                    # - Si ya hay cookie y el input es igual, NO lo mostramos (ya se está usando)
-                    # - Solo aparece si el input está vacío (y no hay cookie) o si el usuario escribe uno DISTINTO
-                    input_norm  = (codigo_familia or "").strip().upper()
-                    cookie_norm = (codigo_cookie_effective or "").strip().upper()
-                    mostrar_usar = (not cookie_norm) or (input_norm and input_norm != cookie_norm)
-        
-                    if mostrar_usar:
-                        if st.button("Usar este código", key=f"autofill_btn_{fkey}_{hkey}", use_container_width=True):
-                            fam = get_familia_por_codigo(codigo_familia)
-                            if not fam:
-                                st.error("Código no válido (o no encontrado).")
-                            else:
-                                hijos = get_hijos_por_codigo(fam["codigo"])
-                                st.session_state[f"padre_{fkey}_{hkey}"] = fam.get("tutor", "")
-                                st.session_state[f"telefono_{fkey}_{hkey}"] = fam.get("telefono", "")
-                                st.session_state[f"email_{fkey}_{hkey}"] = fam.get("email", "")
-                                st.session_state[f"hijos_{fkey}_{hkey}"] = hijos or []
-                                st.session_state[f"autofilled_{fkey}_{hkey}"] = True
-        
-                                # ✅ NO hacemos st.rerun(): el click ya recarga la app.
-                                st.success("Datos cargados.")
-                    else:
-                        st.caption("✅ Ya estás usando el código guardado en este dispositivo.")
-        
-                with col_forget:
-                    if codigo_cookie_effective:
-                        st.markdown(
-                            """
-                            <style>
-                            .forget-link { text-align: right; }
-                            .forget-link div.stButton > button {
-                                background: none !important;
-                                border: none !important;
-                                padding: 0 !important;
-                                margin: 0 !important;
-                                color: #1f77b4 !important;
-                                text-decoration: underline;
-                                font-weight: 400;
-                                box-shadow: none !important;
-                                min-height: 0 !important;
-                                height: auto !important;
-                            }
-                            .forget-link div.stButton > button:hover { opacity: 0.85; }
-                            </style>
-                            """,
-                            unsafe_allow_html=True
-                        )
-                        st.markdown("<div class='forget-link'>", unsafe_allow_html=True)
-                        if st.button(
-                            "Olvidar este código",
-                            key=f"forget_{fkey}_{hkey}",
-                            help="Eliminar el código guardado en este dispositivo",
-                        ):
-                            cookies["family_code"] = ""
-                            cookies.save()
+                tab_manual, tab_auto = st.tabs(["✍️ Rellenar manualmente", "🔐 Autorrellenar con código"])
+
+
+            # ==========================================================
+            # ==========================================================
+            # TAB 1: AUTORELLENAR + RESERVA RÁPIDA
+            # ==========================================================
+            # Fragmento propio: el gate, "Usar este código" y el selector de jugador no rerunean el formulario manual
+            @st.fragment
+            def _pestana_autorrelleno(fkey: str, hkey: str, hora_sesion: str, ok_flag: str, ok_data_key: str, celebrate_key: str):
+                st.markdown("### 🔐 Autorrellenar")
+
+                codigo_cookie = (cookies.get("family_code") or "").strip()
+                gate_key = f"use_cookie_gate_{fkey}_{hkey}"
+
+                # Gate activo solo si hay cookie y aún no han respondido
+                gate_pending = bool(codigo_cookie) and (gate_key not in st.session_state)
+
+                if gate_pending:
+                    st.write(f"Se ha detectado un código guardado en este dispositivo: `{codigo_cookie}`")
+                    st.write("¿Quieres usar el código guardado? Haz doble click")
+
+                    c_yes, c_no = st.columns(2)
+                    with c_yes:
+                        if st.button("✅ Sí", key=f"gate_yes_{fkey}_{hkey}", use_container_width=True):
+                            st.session_state[gate_key] = "yes"
+                    with c_no:
+                        if st.button("❌ No", key=f"gate_no_{fkey}_{hkey}", use_container_width=True):
+                            st.session_state[gate_key] = "no"
+                            # limpiamos cosas de autorellenar por si acaso
                             st.session_state.pop(f"hijos_{fkey}_{hkey}", None)
                             st.session_state.pop(f"autofilled_{fkey}_{hkey}", None)
-                            st.session_state.pop(gate_key, None)  # reset del gate
-                            st.success("Código eliminado de este dispositivo.")
-                            # ✅ sin st.rerun()
-                        st.markdown("</div>", unsafe_allow_html=True)
-        
-                # Autocarga si hay cookie efectiva y aún no se cargó
-                if codigo_cookie_effective and not st.session_state.get(f"autofilled_{fkey}_{hkey}", False):
-                    fam = get_familia_por_codigo(codigo_cookie_effective)
-                    if fam:
-                        hijos = get_hijos_por_codigo(codigo_cookie_effective)
-                        st.session_state[f"padre_{fkey}_{hkey}"] = fam.get("tutor", "")
-                        st.session_state[f"telefono_{fkey}_{hkey}"] = fam.get("telefono", "")
-                        st.session_state[f"email_{fkey}_{hkey}"] = fam.get("email", "")
-                        st.session_state[f"hijos_{fkey}_{hkey}"] = hijos or []
-                        st.session_state[f"autofilled_{fkey}_{hkey}"] = True
-        
-                # 👋 Mensaje simple de bienvenida si hay datos cargados (texto normal, sin caja)
-                tutor_name = to_text(st.session_state.get(f"padre_{fkey}_{hkey}", "")).strip()
-                if tutor_name and st.session_state.get(f"autofilled_{fkey}_{hkey}", False):
-                    st.markdown(
-                        f"Hola, **{tutor_name}**  \n"
-                        "Hemos cargado tus datos guardados para facilitar la reserva."
+
+                    # ✅ NO hacemos st.rerun() aquí.
+                    # En el siguiente rerun natural (por el click) ya se renderizará el else.
+
+                else:
+                    # Si dijeron "no", ignoramos la cookie como valor por defecto
+                    codigo_cookie_effective = "" if (codigo_cookie and st.session_state.get(gate_key) == "no") else codigo_cookie
+
+                    codigo_familia = st.text_input(
+                        "Código de familia",
+                        value=codigo_cookie_effective,
+                        key=f"family_code_{fkey}_{hkey}",
+                        placeholder="Ej: CBC-7F3KQ9P2..."
                     )
 
-            # ==========================
-            # ⚡ RESERVA RÁPIDA
-            # ==========================
-            hijos_cargados = st.session_state.get(f"hijos_{fkey}_{hkey}", [])
-            if hijos_cargados:
-                def _fmt_h(r):
-                    return f"{to_text(r.get('jugador','—'))} · {to_text(r.get('equipo','—'))} · {to_text(r.get('canasta','—'))}"
-            
-                sel_h = st.selectbox(
-                    "Selecciona jugador guardado",
-                    options=hijos_cargados,
-                    format_func=_fmt_h,
-                    key=f"selh_{fkey}_{hkey}"
-                )
-            
-                # ✅ Checkbox estable (con key) justo antes del botón de reservar
-                codigo_cookie_now = (cookies.get("family_code") or "").strip()
-                codigo_input_now = (st.session_state.get(f"family_code_{fkey}_{hkey}") or "").strip()
-                codigo_para_guardar = (codigo_input_now or codigo_cookie_now).strip().upper()
-            
-                # Mostrar checkbox si hay un código candidato y NO hay cookie ya guardada
-                mostrar_guardar = bool(codigo_para_guardar) and not bool(codigo_cookie_now)
-            
-                if mostrar_guardar:
-                    recordar_dispositivo = st.checkbox(
-                        "Guardar este código en este dispositivo",
-                        value=False,
-                        key=f"remember_code_{fkey}_{hkey}",
-                        help="Así no tendrás que volver a rellenar tus datos la próxima vez."
+                    # --- Layout botones ---
+                    col_use, col_forget = st.columns([3, 1], vertical_alignment="center")
+
+                    with col_use:
+                        # ✅ Botón "Usar este código":
+                        # - Si ya hay cookie y el input es igual, NO lo mostramos (ya se está usando)
+                        # - Solo aparece si el input está vacío (y no hay cookie) o si el usuario escribe uno DISTINTO
+                        input_norm  = (codigo_familia or "").strip().upper()
+                        cookie_norm = (codigo_cookie_effective or "").strip().upper()
+                        mostrar_usar = (not cookie_norm) or (input_norm and input_norm != cookie_norm)
+
+                        if mostrar_usar:
+                            if st.button("Usar este código", key=f"autofill_btn_{fkey}_{hkey}", use_container_width=True):
+                                fam = get_familia_por_codigo(codigo_familia)
+                                if not fam:
+                                    st.error("Código no válido (o no encontrado).")
+                                else:
+                                    hijos = get_hijos_por_codigo(fam["codigo"])
+                                    st.session_state[f"padre_{fkey}_{hkey}"] = fam.get("tutor", "")
+                                    st.session_state[f"telefono_{fkey}_{hkey}"] = fam.get("telefono", "")
+                                    st.session_state[f"email_{fkey}_{hkey}"] = fam.get("email", "")
+                                    st.session_state[f"hijos_{fkey}_{hkey}"] = hijos or []
+                                    st.session_state[f"autofilled_{fkey}_{hkey}"] = True
+
+                                    # ✅ NO hacemos st.rerun(): el click ya recarga el fragmento.
+                                    st.success("Datos cargados.")
+                        else:
+                            st.caption("✅ Ya estás usando el código guardado en este dispositivo.")
+
+                    with col_forget:
+                        if codigo_cookie_effective:
+                            st.markdown(
+                                """
+                                <style>
+                                .forget-link { text-align: right; }
+                                .forget-link div.stButton > button {
+                                    background: none !important;
+                                    border: none !important;
+                                    padding: 0 !important;
+                                    margin: 0 !important;
+                                    color: #1f77b4 !important;
+                                    text-decoration: underline;
+                                    font-weight: 400;
+                                    box-shadow: none !important;
+                                    min-height: 0 !important;
+                                    height: auto !important;
+                                }
+                                .forget-link div.stButton > button:hover { opacity: 0.85; }
+                                </style>
+                                """,
+                                unsafe_allow_html=True
+                            )
+                            st.markdown("<div class='forget-link'>", unsafe_allow_html=True)
+                            if st.button(
+                                "Olvidar este código",
+                                key=f"forget_{fkey}_{hkey}",
+                                help="Eliminar el código guardado en este dispositivo",
+                            ):
+                                cookies["family_code"] = ""
+                                cookies.save()
+                                st.session_state.pop(f"hijos_{fkey}_{hkey}", None)
+                                st.session_state.pop(f"autofilled_{fkey}_{hkey}", None)
+                                st.session_state.pop(gate_key, None)  # reset del gate
+                                st.success("Código eliminado de este dispositivo.")
+                                # ✅ sin st.rerun()
+                            st.markdown("</div>", unsafe_allow_html=True)
+
+                    # Autocarga si hay cookie efectiva y aún no se cargó
+                    if codigo_cookie_effective and not st.session_state.get(f"autofilled_{fkey}_{hkey}", False):
+                        fam = get_familia_por_codigo(codigo_cookie_effective)
+                        if fam:
+                            hijos = get_hijos_por_codigo(codigo_cookie_effective)
+                            st.session_state[f"padre_{fkey}_{hkey}"] = fam.get("tutor", "")
+                            st.session_state[f"telefono_{fkey}_{hkey}"] = fam.get("telefono", "")
+                            st.session_state[f"email_{fkey}_{hkey}"] = fam.get("email", "")
+                            st.session_state[f"hijos_{fkey}_{hkey}"] = hijos or []
+                            st.session_state[f"autofilled_{fkey}_{hkey}"] = True
+
+                    # 👋 Mensaje simple de bienvenida si hay datos cargados (texto normal, sin caja)
+                    tutor_name = to_text(st.session_state.get(f"padre_{fkey}_{hkey}", "")).strip()
+                    if tutor_name and st.session_state.get(f"autofilled_{fkey}_{hkey}", False):
+                        st.markdown(
+                            f"Hola, **{tutor_name}**  \n"
+                            "Hemos cargado tus datos guardados para facilitar la reserva."
+                        )
+
+                # ==========================
+                # ⚡ RESERVA RÁPIDA
+                # ==========================
+                hijos_cargados = st.session_state.get(f"hijos_{fkey}_{hkey}", [])
+                if hijos_cargados:
+                    def _fmt_h(r):
+                        return f"{to_text(r.get('jugador','—'))} · {to_text(r.get('equipo','—'))} · {to_text(r.get('canasta','—'))}"
+
+                    sel_h = st.selectbox(
+                        "Selecciona jugador guardado",
+                        options=hijos_cargados,
+                        format_func=_fmt_h,
+                        key=f"selh_{fkey}_{hkey}"
                     )
-                else:
-                    recordar_dispositivo = False
-            
-                if st.button("⚡ Reservar con este jugador", key=f"reserveh_{fkey}_{hkey}", use_container_width=True):
-                    nombre_h = to_text(sel_h.get("jugador", "")).strip()
-                    equipo_h = to_text(sel_h.get("equipo", "")).strip()
-                    canasta_h = to_text(sel_h.get("canasta", "")).strip()
-            
-                    tutor_h = to_text(st.session_state.get(f"padre_{fkey}_{hkey}", "")).strip() or "—"
-                    telefono_h = to_text(st.session_state.get(f"telefono_{fkey}_{hkey}", "")).strip()
-                    email_h = to_text(st.session_state.get(f"email_{fkey}_{hkey}", "")).strip() or "—"
-            
-                    if not nombre_h:
-                        st.error("No se pudo leer el nombre del jugador guardado.")
-                        st.stop()
-            
-                    if not telefono_h or (not str(telefono_h).isdigit()):
-                        st.error("Falta un teléfono válido guardado para esta familia. Pulsa 'Autorrellenar con código' y revisa los datos.")
-                        st.stop()
-            
-                    canasta_h_low = canasta_h.lower()
-                    if "mini" in canasta_h_low:
-                        canasta_final = CATEG_MINI
-                    elif "canasta" in canasta_h_low or "grande" in canasta_h_low:
-                        canasta_final = CATEG_GRANDE
-                    else:
-                        st.error("El jugador guardado no tiene canasta válida (Minibasket / Canasta grande).")
-                        st.stop()
-            
-                    info_tmp = get_sesion_info_mem(fkey, hkey)
-                    if (info_tmp.get("estado", "ABIERTA") or "ABIERTA").upper() == "CERRADA":
-                        st.error("Esta sesión está CERRADA (GLOBAL).")
-                        st.stop()
-            
-                    if get_estado_grupo_mem(fkey, hkey, canasta_final) == "CERRADA":
-                        st.error(f"{canasta_final} está CERRADA para esta sesión. Reserva desde el formulario eligiendo la otra canasta.")
-                        st.stop()
-            
-                    ya = ya_existe_en_sesion_mem(fkey, hkey, nombre_h)
-                    if ya == "inscripciones":
-                        st.error("❌ Este jugador ya está inscrito en esta sesión.")
-                        st.stop()
-                    if ya == "waitlist":
-                        st.warning("ℹ️ Este jugador ya está en lista de espera para esta sesión.")
-                        st.stop()
-            
-                    # ✅ Guardar cookie aquí (estable)
-                    if recordar_dispositivo and codigo_para_guardar:
-                        cookies["family_code"] = codigo_para_guardar
-                        cookies.save()
-            
-                    row = [
-                        dt.datetime.now().isoformat(timespec="seconds"),
-                        fkey, hora_sesion, nombre_h, canasta_final,
-                        (equipo_h or "—"), tutor_h, telefono_h, email_h
-                    ]
-            
-                    libres_cat = plazas_libres_mem(fkey, hkey, canasta_final)
-                    if libres_cat <= 0:
-                        append_row("waitlist", row)
-                        st.session_state[ok_flag] = True
-                        st.session_state[ok_data_key] = {
-                            "status": "wait",
-                            "fecha_iso": fkey,
-                            "fecha_txt": pd.to_datetime(fkey).strftime("%d/%m/%Y"),
-                            "hora": hora_sesion,
-                            "nombre": nombre_h,
-                            "canasta": canasta_final,
-                            "equipo": (equipo_h or "—"),
-                            "tutor": tutor_h,
-                            "telefono": telefono_h,
-                            "email": email_h,
-                            "family_code": codigo_para_guardar if (recordar_dispositivo and codigo_para_guardar) else "",
-                        }
-                        st.rerun()
+
+                    # ✅ Checkbox estable (con key) justo antes del botón de reservar
+                    codigo_cookie_now = (cookies.get("family_code") or "").strip()
+                    codigo_input_now = (st.session_state.get(f"family_code_{fkey}_{hkey}") or "").strip()
+                    codigo_para_guardar = (codigo_input_now or codigo_cookie_now).strip().upper()
+
+                    # Mostrar checkbox si hay un código candidato y NO hay cookie ya guardada
+                    mostrar_guardar = bool(codigo_para_guardar) and not bool(codigo_cookie_now)
+
+                    if mostrar_guardar:
+                        recordar_dispositivo = st.checkbox(
+                            "Guardar este código en este dispositivo",
+                            value=False,
+                            key=f"remember_code_{fkey}_{hkey}",
+                            help="Así no tendrás que volver a rellenar tus datos la próxima vez."
+                        )
                     else:
-                        append_row("inscripciones", row)
+                        recordar_dispositivo = False
+
+                    if st.button("⚡ Reservar con este jugador", key=f"reserveh_{fkey}_{hkey}", use_container_width=True):
+                        nombre_h = to_text(sel_h.get("jugador", "")).strip()
+                        equipo_h = to_text(sel_h.get("equipo", "")).strip()
+                        canasta_h = to_text(sel_h.get("canasta", "")).strip()
+
+                        tutor_h = to_text(st.session_state.get(f"padre_{fkey}_{hkey}", "")).strip() or "—"
+                        telefono_h = to_text(st.session_state.get(f"telefono_{fkey}_{hkey}", "")).strip()
+                        email_h = to_text(st.session_state.get(f"email_{fkey}_{hkey}", "")).strip() or "—"
+
+                        if not nombre_h:
+                            st.error("No se pudo leer el nombre del jugador guardado.")
+                            st.stop()
+
+                        if not telefono_h or (not str(telefono_h).isdigit()):
+                            st.error("Falta un teléfono válido guardado para esta familia. Pulsa 'Autorrellenar con código' y revisa los datos.")
+                            st.stop()
+
+                        canasta_h_low = canasta_h.lower()
+                        if "mini" in canasta_h_low:
+                            canasta_final = CATEG_MINI
+                        elif "canasta" in canasta_h_low or "grande" in canasta_h_low:
+                            canasta_final = CATEG_GRANDE
+                        else:
+                            st.error("El jugador guardado no tiene canasta válida (Minibasket / Canasta grande).")
+                            st.stop()
+
+                        info_tmp = get_sesion_info_mem(fkey, hkey)
+                        if (info_tmp.get("estado", "ABIERTA") or "ABIERTA").upper() == "CERRADA":
+                            st.error("Esta sesión está CERRADA (GLOBAL).")
+                            st.stop()
+
+                        if get_estado_grupo_mem(fkey, hkey, canasta_final) == "CERRADA":
+                            st.error(f"{canasta_final} está CERRADA para esta sesión. Reserva desde el formulario eligiendo la otra canasta.")
+                            st.stop()
+
+                        ya = ya_existe_en_sesion_mem(fkey, hkey, nombre_h)
+                        if ya == "inscripciones":
+                            st.error("❌ Este jugador ya está inscrito en esta sesión.")
+                            st.stop()
+                        if ya == "waitlist":
+                            st.warning("ℹ️ Este jugador ya está en lista de espera para esta sesión.")
+                            st.stop()
+
+                        # ✅ Guardar cookie aquí (estable)
+                        if recordar_dispositivo and codigo_para_guardar:
+                            cookies["family_code"] = codigo_para_guardar
+                            cookies.save()
+
+                        row = [
+                            dt.datetime.now().isoformat(timespec="seconds"),
+                            fkey, hora_sesion, nombre_h, canasta_final,
+                            (equipo_h or "—"), tutor_h, telefono_h, email_h
+                        ]
+
+                        # Revalida y decide inscripción / espera bajo el lock de la sesión
+                        estado_reserva = reservar(row)
+                        if estado_reserva == "inscrito":
+                            st.error("❌ Este jugador ya está inscrito en esta sesión.")
+                            st.stop()
+                        if estado_reserva == "en_espera":
+                            st.warning("ℹ️ Este jugador ya está en lista de espera para esta sesión.")
+                            st.stop()
+                        if estado_reserva == "cerrada":
+                            st.error(f"{canasta_final} está CERRADA para esta sesión.")
+                            st.stop()
+
                         st.session_state[ok_flag] = True
                         st.session_state[ok_data_key] = {
-                            "status": "ok",
+                            "status": estado_reserva,
                             "fecha_iso": fkey,
                             "fecha_txt": pd.to_datetime(fkey).strftime("%d/%m/%Y"),
                             "hora": hora_sesion,
@@ -1605,171 +2610,164 @@ Revisa los campos obligatorios o vuelve a intentarlo.
                             "email": email_h,
                             "family_code": codigo_para_guardar if (recordar_dispositivo and codigo_para_guardar) else "",
                         }
-                        st.session_state[celebrate_key] = True
+                        if estado_reserva == "ok":
+                            st.session_state[celebrate_key] = True
                         st.rerun()
 
-            
-
-        # ==========================================================
-        # TAB 2: FORMULARIO MANUAL
-        # ==========================================================
-        with tab_manual:
-            # ✅ Keys SEPARADAS para que el autorrelleno NO rellene el manual
-            k_nombre   = f"nombre_m_{fkey}_{hkey}"
-            k_canasta  = f"canasta_m_{fkey}_{hkey}"
-            k_equipo_s = f"equipo_sel_m_{fkey}_{hkey}"
-            k_equipo_o = f"equipo_otro_m_{fkey}_{hkey}"
-            k_padre    = f"padre_m_{fkey}_{hkey}"
-            k_tel      = f"telefono_m_{fkey}_{hkey}"
-            k_email    = f"email_m_{fkey}_{hkey}"
-            k_savefam  = f"savefam_m_{fkey}_{hkey}"
-        
-            with st.form(f"form_{fkey}_{hkey}", clear_on_submit=False):
-                st.write("📝 Información del jugador")
-        
-                nombre = st.text_input("Nombre y apellidos del jugador", key=k_nombre)
-        
-                opciones_canasta = []
-                if get_estado_grupo_mem(fkey, hkey, CATEG_MINI) == "ABIERTA":
-                    opciones_canasta.append(CATEG_MINI)
-                if get_estado_grupo_mem(fkey, hkey, CATEG_GRANDE) == "ABIERTA":
-                    opciones_canasta.append(CATEG_GRANDE)
-        
-                canasta = st.radio("Canasta", opciones_canasta, key=k_canasta)
-                err_canasta = st.empty()
-        
-                if canasta == CATEG_MINI:
-                    st.caption("ℹ️ Para **Minibasket** solo se permiten categorías **Benjamín** y **Alevín**.")
-                elif canasta == CATEG_GRANDE:
-                    st.caption("ℹ️ Para **Canasta grande** solo se permiten categorías **Infantil**, **Cadete** y **Junior**.")
-        
-                equipo_sel = st.selectbox("Categoría / Equipo", EQUIPOS_OPCIONES, index=0, key=k_equipo_s)
-                equipo_otro = st.text_input("Especifica la categoría/equipo", key=k_equipo_o) if equipo_sel == "Otro" else ""
-        
-                if equipo_sel and equipo_sel not in ("— Selecciona —", "Otro"):
-                    equipo_val = equipo_sel
-                else:
-                    equipo_val = (equipo_otro or "").strip()
-        
-                err_equipo = st.empty()
-        
-                padre = st.text_input("Nombre del padre/madre/tutor", key=k_padre)
-        
-                telefono = st.text_input(
-                    "Teléfono de contacto del tutor (solo números)",
-                    key=k_tel,
-                    max_chars=9,
-                    placeholder="Ej: 612345678"
-                )
-                err_telefono = st.empty()
-        
-                email = st.text_input("Email", key=k_email)
-        
-                st.caption("Tras pulsar **Reservar**, debe aparecer el botón **“⬇️ Descargar justificante (PDF)”**. Si no aparece, la reserva no se ha completado.")
-                guardar_familia = st.checkbox(
-                    "Guardar estos datos para próximas reservas (Genera código de familia)",
-                    value=True,
-                    key=k_savefam,
-                    help="Genera un código (CBC-XXXX...) para autorrellenar tus datos y los de tus hijos en futuras reservas."
-                )
-                                        
-                enviar = st.form_submit_button("Reservar")
-        
-                if enviar:
-                    err_canasta.empty()
-                    err_equipo.empty()
-                    err_telefono.empty()
-        
-                    hay_error = False
-        
-                    if not nombre:
-                        st.error("Por favor, rellena el **nombre del jugador**.")
-                        hay_error = True
-        
-                    if not telefono:
-                        err_telefono.error("El teléfono es obligatorio.")
-                        hay_error = True
-                    elif not telefono.isdigit():
-                        err_telefono.error("El teléfono solo puede contener números (sin espacios ni guiones).")
-                        hay_error = True
-        
-                    if not equipo_val:
-                        err_equipo.error("La categoría/equipo es obligatoria.")
-                        hay_error = True
+            with tab_auto:
+                _pestana_autorrelleno(fkey, hkey, hora_sesion, ok_flag, ok_data_key, celebrate_key)
+
+            # ==========================================================
+            # TAB 2: FORMULARIO MANUAL
+            # ==========================================================
+            with tab_manual:
+                # ✅ Keys SEPARADAS para que el autorrelleno NO rellene el manual
+                k_nombre   = f"nombre_m_{fkey}_{hkey}"
+                k_canasta  = f"canasta_m_{fkey}_{hkey}"
+                k_equipo_s = f"equipo_sel_m_{fkey}_{hkey}"
+                k_equipo_o = f"equipo_otro_m_{fkey}_{hkey}"
+                k_padre    = f"padre_m_{fkey}_{hkey}"
+                k_tel      = f"telefono_m_{fkey}_{hkey}"
+                k_email    = f"email_m_{fkey}_{hkey}"
+                k_savefam  = f"savefam_m_{fkey}_{hkey}"
+
+                with st.form(f"form_{fkey}_{hkey}", clear_on_submit=False):
+                    st.write("📝 Información del jugador")
+
+                    nombre = st.text_input("Nombre y apellidos del jugador", key=k_nombre)
+
+                    opciones_canasta = []
+                    if get_estado_grupo_mem(fkey, hkey, CATEG_MINI) == "ABIERTA":
+                        opciones_canasta.append(CATEG_MINI)
+                    if get_estado_grupo_mem(fkey, hkey, CATEG_GRANDE) == "ABIERTA":
+                        opciones_canasta.append(CATEG_GRANDE)
+
+                    canasta = st.radio("Canasta", opciones_canasta, key=k_canasta)
+                    err_canasta = st.empty()
+
+                    if canasta == CATEG_MINI:
+                        st.caption("ℹ️ Para **Minibasket** solo se permiten categorías **Benjamín** y **Alevín**.")
+                    elif canasta == CATEG_GRANDE:
+                        st.caption("ℹ️ Para **Canasta grande** solo se permiten categorías **Infantil**, **Cadete** y **Junior**.")
+
+                    equipo_sel = st.selectbox("Categoría / Equipo", EQUIPOS_OPCIONES, index=0, key=k_equipo_s)
+                    equipo_otro = st.text_input("Especifica la categoría/equipo", key=k_equipo_o) if equipo_sel == "Otro" else ""
+
+                    if equipo_sel and equipo_sel not in ("— Selecciona —", "Otro"):
+                        equipo_val = equipo_sel
                     else:
-                        ev = equipo_val.lower()
-                        if canasta == CATEG_MINI and equipo_sel != "Otro":
-                            if not (ev.startswith("benjamín") or ev.startswith("benjamin") or ev.startswith("alevín") or ev.startswith("alevin")):
-                                err_canasta.error("Para Minibasket solo se permiten categorías Benjamín o Alevín.")
-                                hay_error = True
-                        if canasta == CATEG_GRANDE and equipo_sel != "Otro":
-                            if not (ev.startswith("infantil") or ev.startswith("cadete") or ev.startswith("junior")):
-                                err_canasta.error("Para Canasta grande solo se permiten Infantil, Cadete o Junior.")
-                                hay_error = True
-        
-                    if get_estado_grupo_mem(fkey, hkey, canasta) == "CERRADA":
-                        err_canasta.error(f"⚠️ {canasta} está **CERRADA** para esta sesión. Elige la otra canasta.")
-                        hay_error = True
-        
-                    if not hay_error:
-                        ya = ya_existe_en_sesion_mem(fkey, hkey, nombre)
-                        if ya == "inscripciones":
-                            st.error("❌ Este jugador ya está inscrito en esta sesión.")
-                        elif ya == "waitlist":
-                            st.warning("ℹ️ Este jugador ya está en lista de espera para esta sesión.")
+                        equipo_val = (equipo_otro or "").strip()
+
+                    err_equipo = st.empty()
+
+                    padre = st.text_input("Nombre del padre/madre/tutor", key=k_padre)
+
+                    telefono = st.text_input(
+                        "Teléfono de contacto del tutor (solo números)",
+                        key=k_tel,
+                        max_chars=9,
+                        placeholder="Ej: 612345678"
+                    )
+                    err_telefono = st.empty()
+
+                    email = st.text_input("Email", key=k_email)
+
+                    st.caption("Tras pulsar **Reservar**, debe aparecer el botón **“⬇️ Descargar justificante (PDF)”**. Si no aparece, la reserva no se ha completado.")
+                    guardar_familia = st.checkbox(
+                        "Guardar estos datos para próximas reservas (Genera código de familia)",
+                        value=True,
+                        key=k_savefam,
+                        help="Genera un código (CBC-XXXX...) para autorrellenar tus datos y los de tus hijos en futuras reservas."
+                    )
+
+                    enviar = st.form_submit_button("Reservar")
+
+                    if enviar:
+                        err_canasta.empty()
+                        err_equipo.empty()
+                        err_telefono.empty()
+
+                        hay_error = False
+
+                        if not nombre:
+                            st.error("Por favor, rellena el **nombre del jugador**.")
+                            hay_error = True
+
+                        if not telefono:
+                            err_telefono.error("El teléfono es obligatorio.")
+                            hay_error = True
+                        elif not telefono.isdigit():
+                            err_telefono.error("El teléfono solo puede contener números (sin espacios ni guiones).")
+                            hay_error = True
+
+                        if not equipo_val:
+                            err_equipo.error("La categoría/equipo es obligatoria.")
+                            hay_error = True
                         else:
-                            libres_cat = plazas_libres_mem(fkey, hkey, canasta)
-        
-                            row = [
-                                dt.datetime.now().isoformat(timespec="seconds"),
-                                fkey, hora_sesion, nombre, canasta,
-                                (equipo_val or ""), (padre or ""), telefono, (email or "")
-                            ]
-        
-                            family_code = ""
-                            if guardar_familia:
-                                cod_in = codigo_cookie.strip() if codigo_cookie else ""
-                                family_code = upsert_familia_y_hijo(
-                                    cod_in if cod_in else None,
-                                    (padre or ""), telefono, (email or ""),
-                                    nombre, (equipo_val or ""), canasta
-                                )
-                                if family_code:
-                                    cookies["family_code"] = family_code
-                                    cookies.save()
-        
-                            if libres_cat <= 0:
-                                append_row("waitlist", row)
-                                st.session_state[ok_flag] = True
-                                st.session_state[ok_data_key] = {
-                                    "status": "wait",
-                                    "fecha_iso": fkey,
-                                    "fecha_txt": pd.to_datetime(fkey).strftime("%d/%m/%Y"),
-                                    "hora": hora_sesion,
-                                    "nombre": nombre,
-                                    "canasta": canasta,
-                                    "equipo": (equipo_val or "—"),
-                                    "tutor": (padre or "—"),
-                                    "telefono": telefono,
-                                    "email": (email or "—"),
-                                    "family_code": family_code,
-                                }
-                                st.rerun()
+                            ev = equipo_val.lower()
+                            if canasta == CATEG_MINI and equipo_sel != "Otro":
+                                if not (ev.startswith("benjamín") or ev.startswith("benjamin") or ev.startswith("alevín") or ev.startswith("alevin")):
+                                    err_canasta.error("Para Minibasket solo se permiten categorías Benjamín o Alevín.")
+                                    hay_error = True
+                            if canasta == CATEG_GRANDE and equipo_sel != "Otro":
+                                if not (ev.startswith("infantil") or ev.startswith("cadete") or ev.startswith("junior")):
+                                    err_canasta.error("Para Canasta grande solo se permiten Infantil, Cadete o Junior.")
+                                    hay_error = True
+
+                        if get_estado_grupo_mem(fkey, hkey, canasta) == "CERRADA":
+                            err_canasta.error(f"⚠️ {canasta} está **CERRADA** para esta sesión. Elige la otra canasta.")
+                            hay_error = True
+
+                        if not hay_error:
+                            ya = ya_existe_en_sesion_mem(fkey, hkey, nombre)
+                            if ya == "inscripciones":
+                                st.error("❌ Este jugador ya está inscrito en esta sesión.")
+                            elif ya == "waitlist":
+                                st.warning("ℹ️ Este jugador ya está en lista de espera para esta sesión.")
                             else:
-                                append_row("inscripciones", row)
-                                st.session_state[ok_flag] = True
-                                st.session_state[ok_data_key] = {
-                                    "status": "ok",
-                                    "fecha_iso": fkey,
-                                    "fecha_txt": pd.to_datetime(fkey).strftime("%d/%m/%Y"),
-                                    "hora": hora_sesion,
-                                    "nombre": nombre,
-                                    "canasta": canasta,
-                                    "equipo": (equipo_val or "—"),
-                                    "tutor": (padre or "—"),
-                                    "telefono": telefono,
-                                    "email": (email or "—"),
-                                    "family_code": family_code,
-                                }
-                                st.session_state[celebrate_key] = True
-                                st.rerun()
+                                row = [
+                                    dt.datetime.now().isoformat(timespec="seconds"),
+                                    fkey, hora_sesion, nombre, canasta,
+                                    (equipo_val or ""), (padre or ""), telefono, (email or "")
+                                ]
+
+                                family_code = ""
+                                if guardar_familia:
+                                    cod_in = codigo_cookie.strip() if codigo_cookie else ""
+                                    family_code = upsert_familia_y_hijo(
+                                        cod_in if cod_in else None,
+                                        (padre or ""), telefono, (email or ""),
+                                        nombre, (equipo_val or ""), canasta
+                                    )
+                                    if family_code:
+                                        cookies["family_code"] = family_code
+                                        cookies.save()
+
+                                # Revalida y decide inscripción / espera bajo el lock de la sesión
+                                estado_reserva = reservar(row)
+                                if estado_reserva == "inscrito":
+                                    st.error("❌ Este jugador ya está inscrito en esta sesión.")
+                                elif estado_reserva == "en_espera":
+                                    st.warning("ℹ️ Este jugador ya está en lista de espera para esta sesión.")
+                                elif estado_reserva == "cerrada":
+                                    err_canasta.error(f"⚠️ {canasta} está **CERRADA** para esta sesión. Elige la otra canasta.")
+                                else:
+                                    st.session_state[ok_flag] = True
+                                    st.session_state[ok_data_key] = {
+                                        "status": estado_reserva,
+                                        "fecha_iso": fkey,
+                                        "fecha_txt": pd.to_datetime(fkey).strftime("%d/%m/%Y"),
+                                        "hora": hora_sesion,
+                                        "nombre": nombre,
+                                        "canasta": canasta,
+                                        "equipo": (equipo_val or "—"),
+                                        "tutor": (padre or "—"),
+                                        "telefono": telefono,
+                                        "email": (email or "—"),
+                                        "family_code": family_code,
+                                    }
+                                    if estado_reserva == "ok":
+                                        st.session_state[celebrate_key] = True
+                                    st.rerun()
+
+    _zona_reserva(fkey, hkey, hora_sesion)